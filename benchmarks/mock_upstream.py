@@ -0,0 +1,159 @@
+"""Local stand-in for the conversation site, used by the offline benchmarks.
+
+Serves a minimal chat page (a `#prompt-textarea` and a send button that posts
+the conversation like the real page does) and the conversation endpoints,
+which stream a cumulative answer at a fixed token rate.
+
+    python benchmarks/mock_upstream.py --port 8100 --tokens 200 --rate 100
+"""
+
+import argparse
+import asyncio
+import json
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
+
+CHAT_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>ChatGPT</title></head>
+<body>
+<form onsubmit="return false;">
+  <textarea id="prompt-textarea"></textarea>
+  <button data-testid="send-button" type="button" onclick="send()">Send</button>
+</form>
+<script>
+function newId() {
+  return "xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx".replace(/[xy]/g, function (c) {
+    const r = (Math.random() * 16) | 0;
+    return (c === "x" ? r : (r & 0x3) | 0x8).toString(16);
+  });
+}
+async function send() {
+  const textarea = document.getElementById("prompt-textarea");
+  const body = {
+    action: "next",
+    messages: [{
+      id: newId(),
+      author: {role: "user"},
+      content: {content_type: "text", parts: [textarea.value]},
+    }],
+    parent_message_id: newId(),
+    model: "text-davinci-002-render-sha",
+    websocket_request_id: newId(),
+  };
+  textarea.value = "";
+  const response = await fetch("/backend-anon/conversation", {
+    method: "POST",
+    headers: {"content-type": "application/json"},
+    body: JSON.stringify(body),
+  });
+  await response.text();
+}
+</script>
+</body>
+</html>
+"""
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit 你好 世界".split()
+
+
+def event(payload) -> bytes:
+    return f"data: {json.dumps(payload)}\n\n".encode()
+
+
+def message_event(
+    conversation_id: str,
+    message_id: str,
+    role: str,
+    content: str,
+    status: str,
+    finish_type: str = None,
+) -> bytes:
+    metadata = {"model_slug": "text-davinci-002-render-sha"}
+    if finish_type:
+        metadata["finish_details"] = {"type": finish_type}
+    return event(
+        {
+            "message": {
+                "id": message_id,
+                "author": {"role": role},
+                "content": {"content_type": "text", "parts": [content]},
+                "status": status,
+                "metadata": metadata,
+            },
+            "conversation_id": conversation_id,
+            "error": None,
+        }
+    )
+
+
+def create_app(
+    tokens: int = 200, rate: float = 100, heartbeat_every: int = 50
+) -> FastAPI:
+    """`rate` is tokens per second, 0 streams as fast as possible"""
+    app = FastAPI()
+
+    @app.get("/")
+    async def index():
+        return HTMLResponse(CHAT_PAGE)
+
+    async def conversation(request: Request):
+        body = await request.json()
+        prompt = body["messages"][-1]["content"]["parts"][0]
+        conversation_id = str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+
+        async def stream():
+            # 和真实的上游一样，先回显用户的消息
+            yield message_event(
+                conversation_id,
+                str(uuid.uuid4()),
+                "user",
+                prompt,
+                "finished_successfully",
+            )
+            answer = ""
+            for index in range(tokens):
+                if rate:
+                    await asyncio.sleep(1 / rate)
+                if heartbeat_every and index % heartbeat_every == heartbeat_every - 1:
+                    yield b": ping\n\n"
+                answer += WORDS[index % len(WORDS)] + " "
+                yield message_event(
+                    conversation_id, message_id, "assistant", answer, "in_progress"
+                )
+            yield message_event(
+                conversation_id,
+                message_id,
+                "assistant",
+                answer,
+                "finished_successfully",
+                "stop",
+            )
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    app.add_api_route("/backend-api/conversation", conversation, methods=["POST"])
+    app.add_api_route("/backend-anon/conversation", conversation, methods=["POST"])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=100, help="tokens per second")
+    parser.add_argument("--heartbeat-every", type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app(args.tokens, args.rate, args.heartbeat_every)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Replay captured upstream streams through the completion pipeline.
+
+Captures are written by the server when OPENAI_CAPTURE_DIR is set. Each one
+is fed, in the chunks it originally arrived in, through chunks_to_lines ->
+lines_to_messages -> CompletionStream, the same code a live request runs,
+with no browser involved. Reports parse throughput and a digest of the
+deltas of every capture, which can be checked against a golden file to
+make sure an optimization did not change a single output byte.
+
+    PYTHONPATH=. python benchmarks/replay.py captures/ --write-golden golden.json
+    PYTHONPATH=. python benchmarks/replay.py captures/ --golden golden.json
+"""
+
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import time
+
+from llm.provider.openai.capture import load_capture
+from llm.provider.openai.client import OpenAIClient
+from llm.provider.openai.delta import CompletionStream
+
+
+async def iter_chunks(chunks: list[bytes]):
+    for chunk in chunks:
+        yield chunk
+
+
+async def replay(chunks: list[bytes], meta: dict) -> dict:
+    prompts = [message["content"] for message in meta["messages"]]
+    completion_stream = CompletionStream(prompts, meta.get("model") or "")
+    messages = OpenAIClient.lines_to_messages(
+        OpenAIClient.chunks_to_lines(iter_chunks(chunks))
+    )
+    deltas = [delta async for delta in completion_stream.deltas(messages)]
+    return {
+        "deltas": deltas,
+        "model": completion_stream.model,
+        "finish_reason": completion_stream.finish_reason,
+        "error": completion_stream.error,
+    }
+
+
+async def time_replays(captures: list, repeat: int) -> list[tuple[dict, float]]:
+    """Best time of `repeat` runs per capture, all in one event loop"""
+    results = []
+    for _, chunks, meta in captures:
+        best = float("inf")
+        for _ in range(repeat):
+            ts = time.perf_counter()
+            output = await replay(chunks, meta)
+            best = min(best, time.perf_counter() - ts)
+        results.append((output, best))
+    return results
+
+
+def digest(output: dict) -> str:
+    data = json.dumps(output, ensure_ascii=False, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def find_captures(paths: list[str]) -> list[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.sse.gz"))))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="capture files or directories")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--golden", help="check the digests against this file")
+    parser.add_argument("--write-golden", help="write the digests to this file")
+    args = parser.parse_args()
+
+    captures = [(path, *load_capture(path)) for path in find_captures(args.paths)]
+    if not captures:
+        parser.error("no captures found")
+
+    golden = {}
+    if args.golden:
+        with open(args.golden, encoding="utf-8") as f:
+            golden = json.load(f)
+
+    digests = {}
+    mismatches = []
+    total_bytes = 0
+    total_time = 0.0
+    print(f"{'capture':<40} {'status':>6} {'KB':>8} {'deltas':>7} {'MB/s':>8} finish")
+    results = asyncio.run(time_replays(captures, args.repeat))
+    for (path, chunks, meta), (output, best) in zip(captures, results):
+        size = sum(len(chunk) for chunk in chunks)
+        name = os.path.basename(path)
+        digests[name] = digest(output)
+        if name in golden and golden[name] != digests[name]:
+            mismatches.append(name)
+
+        total_bytes += size
+        total_time += best
+        print(
+            f"{name:<40} {meta['status']:>6} {size / 1024:>8.1f} "
+            f"{len(output['deltas']):>7} {size / 1024 / 1024 / best:>8.1f} "
+            f"{output['error'] and 'error' or output['finish_reason']}"
+        )
+
+    print(
+        f"{len(captures)} captures, {total_bytes / 1024 / 1024:.2f} MB, "
+        f"{total_bytes / 1024 / 1024 / total_time:.1f} MB/s"
+    )
+
+    if args.write_golden:
+        with open(args.write_golden, "w", encoding="utf-8") as f:
+            json.dump(digests, f, indent=2, sort_keys=True)
+    if args.golden:
+        missing = sorted(set(golden) - set(digests))
+        if mismatches or missing:
+            for name in mismatches:
+                print(f"MISMATCH {name}")
+            for name in missing:
+                print(f"MISSING {name}")
+            raise SystemExit(1)
+        print(f"all {len(digests)} digests match {args.golden}")
+
+
+if __name__ == "__main__":
+    main()
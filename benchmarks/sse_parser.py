@@ -0,0 +1,134 @@
+"""Micro-benchmark of the upstream SSE parser.
+
+Builds streams shaped like the ChatGPT conversation stream (every event
+carries the cumulative answer so far), splits them into small network
+chunks and times how long the parser takes for growing stream sizes. The
+time per MB should stay flat as the stream grows.
+
+    PYTHONPATH=. python benchmarks/sse_parser.py --sizes 1 2 4 8
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from llm.provider.openai.sse import SSEDecoder
+
+
+def build_stream(size_mb: float, step: int = 8) -> bytes:
+    """One answer growing by `step` words per event until the stream is big enough"""
+    target = int(size_mb * 1024 * 1024)
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit 你好 世界".split()
+
+    out = []
+    total = 0
+    answer = ""
+    while total < target:
+        answer += " ".join(random.choice(words) for _ in range(step)) + " "
+        payload = {
+            "message": {
+                "id": "b2a1c2f4-0000-0000-0000-000000000000",
+                "author": {"role": "assistant"},
+                "content": {"content_type": "text", "parts": [answer]},
+                "status": "in_progress",
+                "metadata": {"model_slug": "gpt-4o"},
+            },
+            "conversation_id": "6c5e4a80-0000-0000-0000-000000000000",
+        }
+        event = f"data: {json.dumps(payload)}\n\n".encode()
+        out.append(event)
+        total += len(event)
+        if random.random() < 0.01:
+            out.append(b": ping\n\n")
+    out.append(b"data: [DONE]\n\n")
+    return b"".join(out)
+
+
+def split_chunks(data: bytes, min_size: int = 64, max_size: int = 512) -> list[bytes]:
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = random.randint(min_size, max_size)
+        chunks.append(data[pos : pos + size])
+        pos += size
+    return chunks
+
+
+async def iter_chunks(chunks: list[bytes]):
+    for chunk in chunks:
+        yield chunk
+
+
+async def parse_decoder(chunks: list[bytes]) -> int:
+    decoder = SSEDecoder()
+    count = 0
+    for chunk in chunks:
+        count += len(decoder.feed(chunk))
+        if decoder.done:
+            break
+    return count
+
+
+async def parse_legacy(chunks: list[bytes]) -> int:
+    """The string based parser the decoder replaced, kept for comparison"""
+    count = 0
+    previous = ""
+    async for chunk in iter_chunks(chunks):
+        buffer_chunk = (
+            chunk.decode(errors="ignore") if isinstance(chunk, bytes) else chunk
+        )
+        previous += buffer_chunk
+        while (eol_index := previous.find("\n")) >= 0:
+            line = previous[: eol_index + 1].strip()
+            if line == "data: [DONE]":
+                break
+            if line.startswith("data: "):
+                count += 1
+            previous = previous[eol_index + 1 :]
+    return count
+
+
+def run(parser, chunks: list[bytes], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        ts = time.perf_counter()
+        asyncio.run(parser(chunks))
+        best = min(best, time.perf_counter() - ts)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--min-chunk", type=int, default=64)
+    parser.add_argument("--max-chunk", type=int, default=512)
+    parser.add_argument(
+        "--legacy", action="store_true", help="also time the old string parser"
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    parsers = [("decoder", parse_decoder)]
+    if args.legacy:
+        parsers.append(("legacy", parse_legacy))
+
+    print(
+        f"{'parser':<8} {'size MB':>8} {'chunks':>8} {'time s':>8} {'MB/s':>8} {'s/MB':>8}"
+    )
+    for size in args.sizes:
+        data = build_stream(size)
+        chunks = split_chunks(data, args.min_chunk, args.max_chunk)
+        mb = len(data) / 1024 / 1024
+        for name, func in parsers:
+            elapsed = run(func, chunks, args.repeat)
+            print(
+                f"{name:<8} {mb:>8.2f} {len(chunks):>8} {elapsed:>8.3f} "
+                f"{mb / elapsed:>8.1f} {elapsed / mb:>8.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""End to end throughput benchmark against a local mock upstream.
+
+Starts benchmarks/mock_upstream.py in process, points the real
+OpenAICrawler/OpenAIClient stack at it (nologin mode, temporary browser
+data) and serves the FastAPI app on a local port. Then sends chat
+completions at a fixed concurrency and reports requests/sec, time to first
+token and latency percentiles for streaming and non-streaming requests.
+
+    PYTHONPATH=. python benchmarks/throughput.py --requests 50 --concurrency 4 --pages 4
+
+The browser comes from playwright (`BROWSER_CHANNEL`, empty for the bundled
+chromium). With --url the load is sent to an already running server instead
+and nothing is started.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import httpx
+import uvicorn
+
+from benchmarks.mock_upstream import create_app as create_upstream
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+class Result:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.ttfts: list[float] = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def report(self, mode: str):
+        done = len(self.latencies)
+        rps = done / self.elapsed if self.elapsed else 0
+        ttft = " ".join(f"{percentile(self.ttfts, q):>7.3f}" for q in (50, 95, 99))
+        latency = " ".join(
+            f"{percentile(self.latencies, q):>7.3f}" for q in (50, 95, 99)
+        )
+        print(f"{mode:<10} {done:>5} {self.errors:>6} {rps:>7.2f} {ttft} {latency}")
+
+
+async def send_stream(client: httpx.AsyncClient, body: dict, result: Result):
+    ts = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", "/v1/chat/completions", json=body) as response:
+        if response.status_code != 200:
+            result.errors += 1
+            return
+        async for line in response.aiter_lines():
+            if ttft is not None or not line.startswith("data: {"):
+                continue
+            chunk = json.loads(line[6:])
+            if chunk["choices"][0]["delta"].get("content"):
+                ttft = time.perf_counter() - ts
+    if ttft is None:
+        result.errors += 1
+        return
+    result.ttfts.append(ttft)
+    result.latencies.append(time.perf_counter() - ts)
+
+
+async def send_json(client: httpx.AsyncClient, body: dict, result: Result):
+    ts = time.perf_counter()
+    response = await client.post("/v1/chat/completions", json=body)
+    if response.status_code != 200 or not response.json().get("choices"):
+        result.errors += 1
+        return
+    # 非流式请求的首个token就是整个回答
+    latency = time.perf_counter() - ts
+    result.ttfts.append(latency)
+    result.latencies.append(latency)
+
+
+async def run_load(
+    url: str, model: str, stream: bool, requests: int, concurrency: int
+) -> Result:
+    result = Result()
+    pending = iter(range(requests))
+    send = send_stream if stream else send_json
+
+    async def worker(client: httpx.AsyncClient):
+        for index in pending:
+            body = {
+                "model": model,
+                "stream": stream,
+                "messages": [{"role": "user", "content": f"benchmark prompt {index}"}],
+            }
+            try:
+                await send(client, body, result)
+            except httpx.HTTPError:
+                result.errors += 1
+
+    async with httpx.AsyncClient(base_url=url, timeout=None) as client:
+        ts = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        result.elapsed = time.perf_counter() - ts
+    return result
+
+
+async def serve(app, port: int) -> tuple[uvicorn.Server, asyncio.Task]:
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+
+    async def run():
+        try:
+            await server.serve()
+        except SystemExit:
+            # uvicorn启动失败时会调用sys.exit
+            pass
+
+    task = asyncio.create_task(run())
+    while not server.started:
+        if task.done():
+            raise RuntimeError(f"Server on port {port} failed to start")
+        await asyncio.sleep(0.1)
+    return server, task
+
+
+def create_api_app():
+    # 读取环境变量后才能导入llm
+    from fastapi import FastAPI
+
+    from llm.api.api import Api
+    from llm.main import lifespan
+
+    app = FastAPI(lifespan=lifespan)
+    Api(app)
+    return app
+
+
+async def main_async(args):
+    servers = []
+    url = args.url
+    try:
+        if not url:
+            upstream, task = await serve(
+                create_upstream(args.tokens, args.rate), args.upstream_port
+            )
+            servers.append((upstream, task))
+            api, task = await serve(create_api_app(), args.api_port)
+            servers.append((api, task))
+            url = f"http://127.0.0.1:{args.api_port}"
+
+        # 预热，页面第一次请求时会捕获请求模板等
+        await run_load(url, args.model, True, 1, 1)
+
+        print(
+            f"{'mode':<10} {'done':>5} {'errors':>6} {'req/s':>7} "
+            f"{'ttft50':>7} {'ttft95':>7} {'ttft99':>7} "
+            f"{'lat50':>7} {'lat95':>7} {'lat99':>7}"
+        )
+        for mode in args.modes:
+            result = await run_load(
+                url, args.model, mode == "stream", args.requests, args.concurrency
+            )
+            result.report(mode)
+    finally:
+        for server, task in reversed(servers):
+            server.should_exit = True
+            await task
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=4, help="OPENAI_PAGE_POOL_SIZE")
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=100, help="tokens per second")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["stream", "non-stream"],
+        choices=["stream", "non-stream"],
+    )
+    parser.add_argument("--upstream-port", type=int, default=8100)
+    parser.add_argument("--api-port", type=int, default=8101)
+    parser.add_argument("--fast-path", action="store_true")
+    parser.add_argument("--headed", action="store_true")
+    args = parser.parse_args()
+
+    if not args.url:
+        os.environ.update(
+            {
+                "OPENAI_HOST": f"http://127.0.0.1:{args.upstream_port}",
+                "OPENAI_FIRST_SITE_URL": "",
+                "OPENAI_LOGIN_TYPE": "nologin",
+                "OPENAI_PAGE_POOL_SIZE": str(args.pages),
+                "OPENAI_FAST_PATH": str(args.fast_path).lower(),
+                "MAX_QUEUE_SIZE": str(args.requests + args.concurrency),
+                "HEADLESS": str(not args.headed).lower(),
+                "BROWSER_DATA": tempfile.mkdtemp(prefix="llm-benchmark-"),
+                "IGNORE_CMD_ARGS_ERRORS": "1",
+            }
+        )
+        os.environ.setdefault("BROWSER_CHANNEL", "")
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,37 @@
-import datetime
-import time
-
 import uvicorn
-from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
 from fastapi.routing import APIRouter
 
 import llm.shared as shared
+from llm.api.middleware import TimingMiddleware
 from llm.logger import logger
 from llm.views.chat import api_chat_completion
+from llm.views.metrics import api_metrics
+from llm.views.status import api_healthz, api_queue_status, api_readyz
 
 
 def api_middleware(app: FastAPI):
-    @app.middleware("http")
-    async def log_and_time(req: Request, call_next):
-        ts = time.time()
-        res: Response = await call_next(req)
-        duration = str(round(time.time() - ts, 4))
-        res.headers["X-Process-Time"] = duration
-        endpoint = req.scope.get("path", "err")
-        if shared.cmd_opts.api_log:
-            print(
-                "API {t} {code} {prot}/{ver} {method} {endpoint} {cli} {duration}".format(
-                    t=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
-                    code=res.status_code,
-                    ver=req.scope.get("http_version", "0.0"),
-                    cli=req.scope.get("client", ("0:0.0.0", 0))[0],
-                    prot=req.scope.get("scheme", "err"),
-                    method=req.scope.get("method", "err"),
-                    endpoint=endpoint,
-                    duration=duration,
-                )
-            )
-        return res
-
     def handle_exception(request: Request, e: Exception):
         message = f"API error: {request.method}: {request.url} {str(e)}"
+
+        if isinstance(e, HTTPException):
+            logger.error(message)
+            err = {
+                "status": False,
+                "error": {
+                    "message": e.detail,
+                    "type": "invalid_request_error",
+                },
+                "support": "https://github.com/adryfish/llm-web-api",
+            }
+            return JSONResponse(
+                status_code=e.status_code,
+                content=jsonable_encoder(err),
+                headers=e.headers,
+            )
+
         # 打印异常堆栈
         logger.error(message, exc_info=True)
 
@@ -50,12 +45,7 @@ def api_middleware(app: FastAPI):
         }
         return JSONResponse(status_code=500, content=jsonable_encoder(err))
 
-    @app.middleware("http")
-    async def exception_handling(request: Request, call_next):
-        try:
-            return await call_next(request)
-        except Exception as e:
-            return handle_exception(request, e)
+    app.add_middleware(TimingMiddleware, on_error=handle_exception)
 
     @app.exception_handler(Exception)
     async def fastapi_exception_handler(request: Request, e: Exception):
@@ -76,6 +66,10 @@ class Api:
         self.add_api_route(
             "/v1/chat/completions", api_chat_completion, methods=["POST"]
         )
+        self.add_api_route("/queue", api_queue_status, methods=["GET"])
+        self.add_api_route("/metrics", api_metrics, methods=["GET"])
+        self.add_api_route("/healthz", api_healthz, methods=["GET"])
+        self.add_api_route("/readyz", api_readyz, methods=["GET"])
 
     def add_api_route(self, path: str, endpoint, **kwargs):
         return self.app.add_api_route(path, endpoint, **kwargs)
@@ -0,0 +1,95 @@
+import datetime
+import time
+from typing import Callable
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import llm.shared as shared
+from llm import timing
+from llm.logger import logger
+
+
+class TimingMiddleware:
+    """Timing header, access log and error mapping as one pure ASGI layer.
+
+    The response body is passed through untouched. The start message is held
+    back until the first body message, so X-Process-Time is the real time to
+    first byte; the whole stream duration goes to the access log. The stages
+    marked on the request's StageTimer by then go out as Server-Timing, and
+    the full breakdown is logged at debug level when the request ends.
+    """
+
+    def __init__(
+        self, app: ASGIApp, on_error: Callable[[Request, Exception], Response]
+    ):
+        self.app = app
+        self.on_error = on_error
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        ts = time.perf_counter()
+        timer = timing.StageTimer()
+        token = timing.current_timer.set(timer)
+        start_message = None
+        response_started = False
+        status_code = 500
+        first_byte = None
+
+        async def send_wrapper(message: Message):
+            nonlocal start_message, response_started, status_code, first_byte
+            if message["type"] == "http.response.start":
+                start_message = message
+                status_code = message["status"]
+                return
+
+            if start_message is not None:
+                first_byte = time.perf_counter() - ts
+                headers = MutableHeaders(scope=start_message)
+                headers["X-Process-Time"] = str(round(first_byte, 4))
+                if timer.stages:
+                    headers["Server-Timing"] = timer.server_timing()
+                await send(start_message)
+                start_message = None
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            if response_started:
+                raise
+            response = self.on_error(Request(scope), e)
+            status_code = response.status_code
+            start_message = None
+            await response(scope, receive, send_wrapper)
+        finally:
+            timing.current_timer.reset(token)
+            duration = time.perf_counter() - ts
+            self.log(scope, status_code, first_byte, duration)
+            if timer.stages:
+                logger.debug(
+                    f"[TimingMiddleware] {scope.get('path')} {timer.summary()}"
+                )
+
+    def log(self, scope: Scope, status_code: int, first_byte, duration: float):
+        if not shared.cmd_opts.api_log:
+            return
+        print(
+            "API {t} {code} {prot}/{ver} {method} {endpoint} {cli} {ttfb} {duration}".format(
+                t=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+                code=status_code,
+                ver=scope.get("http_version", "0.0"),
+                cli=(scope.get("client") or ("0:0.0.0", 0))[0],
+                prot=scope.get("scheme", "err"),
+                method=scope.get("method", "err"),
+                endpoint=scope.get("path", "err"),
+                ttfb=round(first_byte, 4) if first_byte is not None else "-",
+                duration=round(duration, 4),
+            )
+        )
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Callable, Optional
 
 from llm.api.chat import Message
 
@@ -7,6 +7,11 @@ from llm.api.chat import Message
 class AbstractChat(ABC):
     @abstractmethod
     async def chat_completion(
-        self, model: str, messages=list[Message], stream: Optional[bool] = False
+        self,
+        model: str,
+        messages=list[Message],
+        stream: Optional[bool] = False,
+        on_finish: Optional[Callable] = None,
+        on_delta: Optional[Callable] = None,
     ):
         pass
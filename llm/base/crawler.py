@@ -1,10 +1,40 @@
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Callable, Optional
 
 from playwright.async_api import BrowserContext, BrowserType
 
 
 class AbstractCrawler(ABC):
+    # 正在处理和等待处理的请求数，用于多帐号之间的负载均衡
+    outstanding_requests: int = 0
+    # 启动过程中每准备好一个页面调用一次，用于及时增加可接收的请求数
+    on_page_ready: Optional[Callable[[], None]] = None
+    # 启动失败的原因
+    startup_error: Optional[str] = None
+
+    @property
+    def capacity(self) -> int:
+        """How many requests the crawler can serve at the same time"""
+        return 1
+
+    @property
+    def idle_capacity(self) -> int:
+        """How many requests the crawler can start right away"""
+        return max(self.capacity - self.outstanding_requests, 0)
+
+    @property
+    def starting(self) -> bool:
+        """Whether the crawler may still get pages without a restart"""
+        return False
+
+    def page_stats(self) -> dict[str, int]:
+        """Number of pages in each state, reported on /metrics"""
+        return {}
+
+    def startup_status(self) -> dict:
+        """Startup progress of the crawler, reported on /readyz"""
+        return {}
+
     @abstractmethod
     async def start(self):
         pass
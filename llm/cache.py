@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Union
+
+from fastapi.responses import StreamingResponse
+
+from llm import config, metrics
+from llm.api.chat import Message
+from llm.logger import logger
+from llm.provider.openai.encoder import (
+    ChunkEncoder,
+    completion_response,
+    generate_completion_id,
+)
+
+# 流式返回缓存内容时，每个chunk的字符数
+REPLAY_CHUNK_SIZE = 32
+
+
+class CacheControl:
+    """Cache policy of one request, from its Cache-Control header.
+
+    no-cache skips the lookup but stores the new answer, no-store does
+    neither, max-age=N only accepts answers younger than N seconds.
+    """
+
+    def __init__(self, header: Optional[str] = None):
+        directives = {}
+        for directive in (header or "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            directives[name] = value.strip('"')
+
+        self.store = "no-store" not in directives
+        self.lookup = self.store and "no-cache" not in directives
+        try:
+            self.max_age = float(directives["max-age"])
+        except (KeyError, ValueError):
+            self.max_age = None
+
+
+class CacheEntry:
+    def __init__(
+        self,
+        content: str,
+        model: str,
+        finish_reason: str,
+        created_at: Optional[float] = None,
+    ):
+        self.content = content
+        self.model = model
+        self.finish_reason = finish_reason
+        self.created_at = created_at or time.time()
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+    def to_dict(self) -> dict:
+        return {
+            "content": self.content,
+            "model": self.model,
+            "finish_reason": self.finish_reason,
+            "created_at": self.created_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CacheEntry":
+        return cls(
+            data["content"], data["model"], data["finish_reason"], data["created_at"]
+        )
+
+
+class MemoryCache:
+    """LRU of at most `max_entries` entries"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        self._entries.pop(key, None)
+
+
+class DiskCache:
+    """One JSON file per entry, the least recently used are removed once the
+    directory grows past `max_bytes`. Reads refresh the file's mtime.
+
+    The methods do blocking file IO and are meant to run in a thread; they
+    are safe to run in several threads at once.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size: Optional[int] = None
+        # 写入在多个线程中同时执行，统计大小和清理时加锁
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _files(self) -> list[tuple[float, int, str]]:
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                # 跳过其他线程还没有写完的临时文件
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = CacheEntry.from_dict(json.load(f))
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(entry.to_dict(), ensure_ascii=False).encode()
+        # 同一个key可能被同时写入，每次写入使用不同的临时文件
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(size for _, size, _ in self._files())
+                try:
+                    self._size -= os.path.getsize(path)
+                except OSError:
+                    pass
+                os.replace(tmp_path, path)
+                self._size += len(data)
+
+                if self._size > self.max_bytes:
+                    self._evict()
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def delete(self, key: str):
+        path = self._path(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return
+            if self._size is not None:
+                self._size -= size
+
+    def _evict(self):
+        # 一次删到容量的90%，避免每次写入都要遍历目录
+        files = sorted(self._files())
+        self._size = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for _, size, path in files:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+class ResponseCache:
+    """Finished answers keyed on the normalized (model, messages) pair.
+
+    Lookups go to the memory tier first, then to the disk tier, which
+    survives restarts. Entries older than `ttl` seconds are ignored.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        memory_size: int,
+        directory: Optional[str] = None,
+        disk_size: int = 0,
+    ):
+        self.ttl = ttl
+        self.memory = MemoryCache(memory_size)
+        self.disk = DiskCache(directory, disk_size) if directory and disk_size else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @staticmethod
+    def key(model: str, messages: list[Message]) -> str:
+        normalized = [
+            [message.role.strip().lower(), message.content.strip()]
+            for message in messages
+        ]
+        data = json.dumps([model.strip().lower(), normalized], ensure_ascii=False)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _fresh(self, entry: CacheEntry, max_age: Optional[float]) -> bool:
+        max_age = self.ttl if max_age is None else min(max_age, self.ttl)
+        return entry.age <= max_age
+
+    async def get(
+        self, key: str, max_age: Optional[float] = None
+    ) -> Optional[CacheEntry]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            if self._fresh(entry, max_age):
+                metrics.CACHE.inc(result="memory_hit")
+                return entry
+            if entry.age > self.ttl:
+                self.memory.delete(key)
+
+        if self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.get, key)
+            if entry is not None and self._fresh(entry, max_age):
+                self.memory.set(key, entry)
+                metrics.CACHE.inc(result="disk_hit")
+                return entry
+
+        metrics.CACHE.inc(result="miss")
+        return None
+
+    def put(self, key: str, entry: CacheEntry):
+        self.memory.set(key, entry)
+        if self.disk is not None:
+            # 写磁盘放到线程中执行，不阻塞当前请求
+            future = asyncio.get_running_loop().run_in_executor(
+                None, self.disk.set, key, entry
+            )
+            future.add_done_callback(self._log_disk_error)
+
+    @staticmethod
+    def _log_disk_error(future: asyncio.Future):
+        if not future.cancelled() and future.exception():
+            logger.error(
+                f"[ResponseCache.put] Fail to write disk cache: {future.exception()}"
+            )
+
+    def respond(
+        self, entry: CacheEntry, stream: bool
+    ) -> Union[dict, StreamingResponse]:
+        """Serve a cached answer as a new completion"""
+        request_id = generate_completion_id("chatcmpl-")
+        created = int(time.time())
+        if not stream:
+            return completion_response(
+                request_id, created, entry.model, entry.content, entry.finish_reason
+            )
+
+        encoder = ChunkEncoder(request_id, created, entry.model)
+
+        async def frames():
+            for start in range(0, len(entry.content), REPLAY_CHUNK_SIZE):
+                yield encoder.encode(entry.content[start : start + REPLAY_CHUNK_SIZE])
+            yield encoder.encode("", entry.finish_reason)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(frames(), media_type="text/event-stream")
+
+
+response_cache = ResponseCache(
+    ttl=config.CACHE_TTL,
+    memory_size=config.CACHE_MEMORY_SIZE,
+    directory=config.CACHE_DIR,
+    disk_size=int(config.CACHE_DISK_SIZE * 1024 * 1024),
+)
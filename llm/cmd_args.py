@@ -25,6 +25,23 @@ parser.add_argument(
     default=30,
     help="set timeout_keep_alive for uvicorn",
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="run this many worker processes, each with its own browser, behind a dispatcher on --port",
+)
+parser.add_argument(
+    "--gateway",
+    action="store_true",
+    help="run as a gateway that forwards requests to the worker nodes registered with it",
+)
+parser.add_argument(
+    "--worker-index",
+    type=int,
+    default=None,
+    help="set by the dispatcher for the worker processes it starts",
+)
 
 # parser.add_argument(
 #     "--enabled-provider",
@@ -17,12 +17,106 @@ USER_AGENT = os.getenv("USER_AGENT", None)
 SAVE_LOGIN_STATE = os.getenv("SAVE_LOGIN_STATE", True)
 
 BROWSER_PATH = os.getenv("BROWSER_PATH", None)
+# 通过cloudflare验证的最长时间(秒)，超时后放弃
+CLOUDFLARE_BYPASS_TIMEOUT = float(os.getenv("CLOUDFLARE_BYPASS_TIMEOUT", "180"))
+# playwright使用的浏览器渠道，留空则使用playwright自带的chromium
+BROWSER_CHANNEL = os.getenv("BROWSER_CHANNEL", "chrome") or None
 BROWSER_DATA = os.path.join(os.getenv("BROWSER_DATA", os.getcwd()), "browser_data")
 os.makedirs(BROWSER_DATA, exist_ok=True)
 
+# 拦截页面上不需要的请求(图片、字体、统计脚本等)，加快页面加载，减少内存
+BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "false").lower() == "true"
+# 允许加载的资源类型，其他类型的请求都会被拦截
+ALLOWED_RESOURCE_TYPES = [
+    resource_type.strip()
+    for resource_type in os.getenv(
+        "ALLOWED_RESOURCE_TYPES",
+        "document,stylesheet,script,xhr,fetch,websocket,eventsource,manifest,other",
+    ).split(",")
+    if resource_type.strip()
+]
+# 允许访问的域名(包括子域名)，对话网站和登录站点的域名总是允许，email登录时登录页面的域名也总是允许
+ALLOWED_HOSTS = [
+    host.strip().lower()
+    for host in os.getenv(
+        "ALLOWED_HOSTS", "oaistatic.com,oaiusercontent.com,challenges.cloudflare.com"
+    ).split(",")
+    if host.strip()
+]
+
 env = os.getenv("env", "prod")
 
 
+# 对话网站的地址，基准测试时指向本地的模拟服务
+OPENAI_HOST = os.getenv("OPENAI_HOST", "https://sharegpt.new.oaifree.com").rstrip("/")
+# 打开对话网站之前需要先登录的站点，留空则跳过
+OPENAI_FIRST_SITE_URL = os.getenv("OPENAI_FIRST_SITE_URL", "http://60.205.200.121:40/")
+
 OPENAI_LOGIN_TYPE = os.getenv("OPENAI_LOGIN_TYPE", "nologin")
 OPENAI_LOGIN_EMAIL = os.getenv("OPENAI_LOGIN_EMAIL", "")
 OPENAI_LOGIN_PASSWORD = os.getenv("OPENAI_LOGIN_PASSWORD", "")
+# 多帐号登录，格式为 email1:password1,email2:password2
+# 未设置时使用 OPENAI_LOGIN_EMAIL 和 OPENAI_LOGIN_PASSWORD
+OPENAI_ACCOUNTS = [
+    tuple(account.strip().split(":", 1))
+    for account in os.getenv("OPENAI_ACCOUNTS", "").split(",")
+    if ":" in account
+] or [(OPENAI_LOGIN_EMAIL, OPENAI_LOGIN_PASSWORD)]
+
+# 每个浏览器上下文打开的页面数量，每个页面同一时间处理一个请求
+OPENAI_PAGE_POOL_SIZE = int(os.getenv("OPENAI_PAGE_POOL_SIZE", "1"))
+
+# 检查页面内存的间隔(秒)，0表示不检查。超过下面任一限制的页面会被替换
+PAGE_WATCHDOG_INTERVAL = float(os.getenv("PAGE_WATCHDOG_INTERVAL", "0"))
+# 页面JS堆的最大值(MB)
+PAGE_MAX_JS_HEAP = float(os.getenv("PAGE_MAX_JS_HEAP", "512"))
+# 页面DOM节点的最大数量
+PAGE_MAX_DOM_NODES = int(os.getenv("PAGE_MAX_DOM_NODES", "50000"))
+# 一个页面最多处理的对话数，0表示不限制
+PAGE_MAX_CONVERSATIONS = int(os.getenv("PAGE_MAX_CONVERSATIONS", "500"))
+
+# 排队的最大请求数，超过后直接返回429
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "64"))
+# 请求排队的最长时间(秒)，超时后返回429；也用于在帐号内等待空闲页面
+MAX_QUEUE_WAIT = float(os.getenv("MAX_QUEUE_WAIT", "60"))
+
+# 捕获一次页面发出的对话请求后，直接用httpx发送后续请求，不再操作页面
+OPENAI_FAST_PATH = os.getenv("OPENAI_FAST_PATH", "false").lower() == "true"
+# 请求模板的有效期(秒)，过期或被拒绝后重新从页面捕获
+OPENAI_FAST_PATH_TTL = float(os.getenv("OPENAI_FAST_PATH_TTL", "300"))
+
+# 多轮对话接着上游已有的对话发送，只发送新的消息，只在email登录模式下有效
+OPENAI_REUSE_THREADS = os.getenv("OPENAI_REUSE_THREADS", "false").lower() == "true"
+# 记录的对话数量和有效期(秒)
+OPENAI_THREAD_CACHE_SIZE = int(os.getenv("OPENAI_THREAD_CACHE_SIZE", "1024"))
+OPENAI_THREAD_TTL = float(os.getenv("OPENAI_THREAD_TTL", "3600"))
+
+# 保存上游返回的原始对话流(gzip压缩)，用于回放测试，留空则不保存
+OPENAI_CAPTURE_DIR = os.getenv("OPENAI_CAPTURE_DIR", "")
+
+# 相同(model, messages)请求的缓存时间(秒)，0表示不使用缓存
+CACHE_TTL = float(os.getenv("CACHE_TTL", "0"))
+# 内存缓存的最大条数
+CACHE_MEMORY_SIZE = int(os.getenv("CACHE_MEMORY_SIZE", "1024"))
+# 磁盘缓存的最大容量(MB)，重启后仍然有效，0表示不使用磁盘缓存
+CACHE_DISK_SIZE = float(os.getenv("CACHE_DISK_SIZE", "256"))
+CACHE_DIR = os.path.join(os.getenv("CACHE_DIR", os.getcwd()), "cache_data")
+
+# 相同(model, messages)的请求同时到达时，只向上游发送一次，回答分发给所有请求
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "false").lower() == "true"
+
+# 网关模式(--gateway)使用的worker注册表，memory只在网关进程内有效，sqlite可以由多个网关进程共享
+GATEWAY_REGISTRY = os.getenv("GATEWAY_REGISTRY", "memory")
+GATEWAY_DB = os.getenv("GATEWAY_DB", os.path.join(os.getcwd(), "gateway.db"))
+# worker注册和心跳时需要携带的令牌，网关模式必须设置
+GATEWAY_TOKEN = os.getenv("GATEWAY_TOKEN", "")
+# 一次租约的最长时间(秒)，网关异常退出时，未释放的租约在过期后自动释放
+GATEWAY_LEASE_TTL = float(os.getenv("GATEWAY_LEASE_TTL", "300"))
+# worker节点：网关地址，设置后定时向网关发送心跳，留空则不注册
+GATEWAY_URL = os.getenv("GATEWAY_URL", "").rstrip("/")
+# worker节点：网关访问本节点使用的地址
+WORKER_URL = os.getenv("WORKER_URL", "").rstrip("/")
+# worker节点：在网关中的名字，默认使用 WORKER_URL
+WORKER_ID = os.getenv("WORKER_ID", WORKER_URL)
+# 心跳间隔(秒)，网关超过3个间隔没有收到心跳就不再转发请求
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "5"))
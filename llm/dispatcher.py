@@ -0,0 +1,68 @@
+from typing import Callable
+
+import httpx
+from fastapi import Request
+
+from llm.streaming import ClosingIterator, ClosingStreamingResponse
+
+# 逐跳头部只对一个连接有效，转发时去掉
+HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+
+
+def forward_headers(headers) -> dict[str, str]:
+    return {
+        name: value
+        for name, value in headers.items()
+        if name.lower() not in HOP_HEADERS
+    }
+
+
+async def forward(
+    client: httpx.AsyncClient,
+    base_url: str,
+    request: Request,
+    body: bytes,
+    on_close: Callable[[], None],
+) -> ClosingStreamingResponse:
+    """Send the request to a server behind the dispatcher and stream its answer back.
+
+    `on_close` runs once the answer is fully relayed, the relay fails or the
+    client leaves. Connection errors are raised before anything reaches the
+    client, so the caller can retry them on another server.
+    """
+    upstream_request = client.build_request(
+        request.method,
+        base_url + request.url.path,
+        params=request.query_params,
+        headers=forward_headers(request.headers),
+        content=body,
+    )
+    try:
+        response = await client.send(upstream_request, stream=True)
+    except BaseException:
+        on_close()
+        raise
+
+    async def relay():
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+
+    return ClosingStreamingResponse(
+        ClosingIterator(relay(), on_close),
+        status_code=response.status_code,
+        headers=forward_headers(response.headers),
+    )
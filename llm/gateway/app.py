@@ -0,0 +1,174 @@
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+import uvicorn
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from llm import config
+from llm.dispatcher import forward
+from llm.gateway.registry import WorkerRegistry, create_registry
+from llm.logger import logger
+
+# 没有空闲worker时，重新申请租约的间隔(秒)
+LEASE_RETRY_INTERVAL = 0.2
+# 超过这么多个心跳间隔没有收到心跳，worker被认为已经下线
+MISSED_HEARTBEATS = 3
+
+
+class Heartbeat(BaseModel):
+    url: str
+    capacity: int
+    models: list[str]
+
+
+class Gateway:
+    """Leases request slots on registered worker nodes and relays their answers.
+
+    Workers are ordinary servers of this project, each with its own browsers.
+    They send heartbeats with their capacity and models; a chat completion
+    takes a lease on the live worker with the most free slots, waits up to
+    MAX_QUEUE_WAIT for one when all are busy, and gives it back once the
+    answer is relayed.
+    """
+
+    def __init__(self, registry: WorkerRegistry):
+        self.registry = registry
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(5, read=None))
+        self._releases: set[asyncio.Task] = set()
+
+    def check_token(self, authorization: Optional[str] = Header(None)):
+        if (
+            not config.GATEWAY_TOKEN
+            or authorization != f"Bearer {config.GATEWAY_TOKEN}"
+        ):
+            raise HTTPException(status_code=401, detail="Invalid gateway token")
+
+    def release_later(self, lease_id: str):
+        task = asyncio.get_running_loop().create_task(self.registry.release(lease_id))
+        self._releases.add(task)
+        task.add_done_callback(self._releases.discard)
+
+    async def chat_completion(self, request: Request):
+        body = await request.body()
+        try:
+            model = json.loads(body)["model"]
+        except (ValueError, KeyError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid request body")
+
+        deadline = time.monotonic() + config.MAX_QUEUE_WAIT
+        tried = set()
+        while True:
+            lease = await self.registry.lease(model, config.GATEWAY_LEASE_TTL, tried)
+            if lease is None:
+                workers = await self.registry.workers()
+                if not any(
+                    model in worker.models and worker.id not in tried
+                    for worker in workers
+                ):
+                    raise HTTPException(
+                        status_code=503, detail=f"No worker serves model {model}"
+                    )
+                if time.monotonic() > deadline:
+                    raise HTTPException(
+                        status_code=429,
+                        detail="All workers are busy",
+                        headers={"Retry-After": "1"},
+                    )
+                await asyncio.sleep(LEASE_RETRY_INTERVAL)
+                continue
+
+            try:
+                return await forward(
+                    self.client,
+                    lease.url,
+                    request,
+                    body,
+                    lambda lease_id=lease.id: self.release_later(lease_id),
+                )
+            except httpx.ConnectError:
+                # 请求还没有发出，换一个worker，它重新发送心跳后才会再被使用
+                logger.error(
+                    f"[Gateway.chat_completion] Worker {lease.worker_id} refused the connection"
+                )
+                await self.registry.remove(lease.worker_id)
+                tried.add(lease.worker_id)
+            except httpx.HTTPError as e:
+                logger.error(
+                    f"[Gateway.chat_completion] Worker {lease.worker_id} failed: {e!r}"
+                )
+                raise HTTPException(status_code=502, detail="Worker failed")
+
+
+def create_app(gateway: Gateway) -> FastAPI:
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        try:
+            yield
+        finally:
+            await gateway.client.aclose()
+
+    app = FastAPI(lifespan=lifespan)
+    authorized = [Depends(gateway.check_token)]
+
+    @app.post("/v1/chat/completions")
+    async def chat_completion(request: Request):
+        return await gateway.chat_completion(request)
+
+    @app.post("/gateway/workers/{worker_id}/heartbeat", dependencies=authorized)
+    async def heartbeat(worker_id: str, body: Heartbeat):
+        await gateway.registry.heartbeat(
+            worker_id, body.url.rstrip("/"), body.capacity, body.models
+        )
+        return {"status": "ok"}
+
+    @app.delete("/gateway/workers/{worker_id}", dependencies=authorized)
+    async def remove(worker_id: str):
+        await gateway.registry.remove(worker_id)
+        logger.info(f"[Gateway.remove] Worker {worker_id} left")
+        return {"status": "ok"}
+
+    @app.get("/gateway/workers")
+    async def workers():
+        return [worker.to_dict() for worker in await gateway.registry.workers()]
+
+    @app.get("/healthz")
+    async def healthz():
+        return {"status": "ok"}
+
+    @app.get("/readyz")
+    async def readyz():
+        workers = await gateway.registry.workers()
+        ready = any(worker.capacity > 0 for worker in workers)
+        return JSONResponse(
+            status_code=200 if ready else 503,
+            content={
+                "ready": ready,
+                "workers": [worker.to_dict() for worker in workers],
+            },
+        )
+
+    return app
+
+
+def run_gateway(port: int, timeout_keep_alive: int):
+    # 没有令牌时任何人都能注册worker并收到用户的请求
+    if not config.GATEWAY_TOKEN:
+        raise ValueError("GATEWAY_TOKEN is required in gateway mode")
+    registry = create_registry(
+        config.GATEWAY_REGISTRY,
+        config.GATEWAY_DB,
+        heartbeat_timeout=config.HEARTBEAT_INTERVAL * MISSED_HEARTBEATS,
+    )
+    logger.info(f"[run_gateway] Gateway with {config.GATEWAY_REGISTRY} registry")
+    uvicorn.run(
+        create_app(Gateway(registry)),
+        host="0.0.0.0",
+        port=port,
+        timeout_keep_alive=timeout_keep_alive,
+    )
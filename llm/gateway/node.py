@@ -0,0 +1,46 @@
+import asyncio
+from typing import Callable
+
+import httpx
+
+from llm import config
+from llm.logger import logger
+
+
+def heartbeat_body() -> dict:
+    """Capacity of this node and the models its ready accounts serve"""
+    from llm.provider_manager import provider_manager
+
+    return {
+        "url": config.WORKER_URL,
+        "capacity": provider_manager.capacity,
+        "models": provider_manager.models,
+    }
+
+
+async def report_to_gateway(body: Callable[[], dict] = heartbeat_body):
+    """Send heartbeats to the gateway until cancelled, then leave it"""
+    headers = (
+        {"Authorization": f"Bearer {config.GATEWAY_TOKEN}"}
+        if config.GATEWAY_TOKEN
+        else {}
+    )
+    url = f"{config.GATEWAY_URL}/gateway/workers/{config.WORKER_ID}"
+    async with httpx.AsyncClient(
+        timeout=config.HEARTBEAT_INTERVAL, headers=headers
+    ) as client:
+        try:
+            while True:
+                try:
+                    response = await client.post(f"{url}/heartbeat", json=body())
+                    response.raise_for_status()
+                except httpx.HTTPError as e:
+                    logger.error(
+                        f"[report_to_gateway] Fail to send heartbeat: {str(e)}"
+                    )
+                await asyncio.sleep(config.HEARTBEAT_INTERVAL)
+        finally:
+            try:
+                await client.delete(url)
+            except httpx.HTTPError:
+                pass
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Optional
+
+
+class WorkerInfo:
+    def __init__(
+        self,
+        worker_id: str,
+        url: str,
+        capacity: int,
+        models: list[str],
+        last_seen: float,
+        leases: int = 0,
+    ):
+        self.id = worker_id
+        self.url = url
+        self.capacity = capacity
+        self.models = models
+        self.last_seen = last_seen
+        self.leases = leases
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "url": self.url,
+            "capacity": self.capacity,
+            "models": self.models,
+            "leases": self.leases,
+            "last_seen": self.last_seen,
+        }
+
+
+class Lease:
+    """One request slot on a worker, freed on release or when it expires"""
+
+    def __init__(self, lease_id: str, worker_id: str, url: str, expires_at: float):
+        self.id = lease_id
+        self.worker_id = worker_id
+        self.url = url
+        self.expires_at = expires_at
+
+
+class WorkerRegistry(ABC):
+    """Worker nodes known to the gateway and the leases handed out on them.
+
+    A worker is live while its last heartbeat is younger than
+    `heartbeat_timeout`. Live leases count against its capacity, and a lease
+    is always taken on the live worker with the most free slots.
+    """
+
+    def __init__(self, heartbeat_timeout: float):
+        self.heartbeat_timeout = heartbeat_timeout
+
+    @staticmethod
+    def pick(
+        workers: list[WorkerInfo], model: str, exclude: set[str]
+    ) -> Optional[WorkerInfo]:
+        candidates = [
+            worker
+            for worker in workers
+            if worker.id not in exclude
+            and model in worker.models
+            and worker.leases < worker.capacity
+        ]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda worker: worker.capacity - worker.leases)
+
+    @abstractmethod
+    async def heartbeat(
+        self, worker_id: str, url: str, capacity: int, models: list[str]
+    ):
+        """Register a worker or refresh it"""
+
+    @abstractmethod
+    async def remove(self, worker_id: str):
+        pass
+
+    @abstractmethod
+    async def workers(self) -> list[WorkerInfo]:
+        """Live workers with their number of live leases"""
+
+    @abstractmethod
+    async def lease(
+        self, model: str, ttl: float, exclude: Optional[set[str]] = None
+    ) -> Optional[Lease]:
+        """A slot on a live worker serving the model, None if all are busy"""
+
+    @abstractmethod
+    async def release(self, lease_id: str):
+        pass
+
+
+class MemoryRegistry(WorkerRegistry):
+    """Registry of a single gateway process"""
+
+    def __init__(self, heartbeat_timeout: float):
+        super().__init__(heartbeat_timeout)
+        self._workers: dict[str, WorkerInfo] = {}
+        self._leases: dict[str, Lease] = {}
+
+    async def heartbeat(
+        self, worker_id: str, url: str, capacity: int, models: list[str]
+    ):
+        self._workers[worker_id] = WorkerInfo(
+            worker_id, url, capacity, models, time.time()
+        )
+
+    async def remove(self, worker_id: str):
+        self._workers.pop(worker_id, None)
+
+    async def workers(self) -> list[WorkerInfo]:
+        now = time.time()
+        self._leases = {
+            lease_id: lease
+            for lease_id, lease in self._leases.items()
+            if lease.expires_at > now
+        }
+        workers = [
+            worker
+            for worker in self._workers.values()
+            if now - worker.last_seen < self.heartbeat_timeout
+        ]
+        for worker in workers:
+            worker.leases = sum(
+                1 for lease in self._leases.values() if lease.worker_id == worker.id
+            )
+        return workers
+
+    async def lease(
+        self, model: str, ttl: float, exclude: Optional[set[str]] = None
+    ) -> Optional[Lease]:
+        worker = self.pick(await self.workers(), model, exclude or set())
+        if worker is None:
+            return None
+        lease = Lease(uuid.uuid4().hex, worker.id, worker.url, time.time() + ttl)
+        self._leases[lease.id] = lease
+        return lease
+
+    async def release(self, lease_id: str):
+        self._leases.pop(lease_id, None)
+
+
+class SqliteRegistry(WorkerRegistry):
+    """Registry in a SQLite file, shared by gateway processes on one machine.
+
+    Leases are taken inside an immediate transaction, so two gateways never
+    hand out the same slot. The queries run in a thread.
+    """
+
+    def __init__(self, path: str, heartbeat_timeout: float):
+        super().__init__(heartbeat_timeout)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, url TEXT,"
+            " capacity INTEGER, models TEXT, last_seen REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (id TEXT PRIMARY KEY,"
+            " worker_id TEXT, expires_at REAL)"
+        )
+
+    async def _run(self, func, *args):
+        def run():
+            with self._lock:
+                return func(*args)
+
+        return await asyncio.to_thread(run)
+
+    def _live_workers(self) -> list[WorkerInfo]:
+        now = time.time()
+        self._conn.execute("DELETE FROM leases WHERE expires_at <= ?", (now,))
+        rows = self._conn.execute(
+            "SELECT w.id, w.url, w.capacity, w.models, w.last_seen, COUNT(l.id)"
+            " FROM workers w LEFT JOIN leases l ON l.worker_id = w.id"
+            " WHERE w.last_seen > ? GROUP BY w.id",
+            (now - self.heartbeat_timeout,),
+        ).fetchall()
+        return [
+            WorkerInfo(worker_id, url, capacity, json.loads(models), last_seen, leases)
+            for worker_id, url, capacity, models, last_seen, leases in rows
+        ]
+
+    def _heartbeat(self, worker_id: str, url: str, capacity: int, models: list[str]):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?)",
+            (worker_id, url, capacity, json.dumps(models), time.time()),
+        )
+
+    def _remove(self, worker_id: str):
+        self._conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+    def _workers(self) -> list[WorkerInfo]:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            return self._live_workers()
+        finally:
+            self._conn.execute("COMMIT")
+
+    def _lease(self, model: str, ttl: float, exclude: set[str]) -> Optional[Lease]:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            worker = self.pick(self._live_workers(), model, exclude)
+            if worker is None:
+                return None
+            lease = Lease(uuid.uuid4().hex, worker.id, worker.url, time.time() + ttl)
+            self._conn.execute(
+                "INSERT INTO leases VALUES (?, ?, ?)",
+                (lease.id, lease.worker_id, lease.expires_at),
+            )
+            return lease
+        finally:
+            self._conn.execute("COMMIT")
+
+    def _release(self, lease_id: str):
+        self._conn.execute("DELETE FROM leases WHERE id = ?", (lease_id,))
+
+    async def heartbeat(
+        self, worker_id: str, url: str, capacity: int, models: list[str]
+    ):
+        await self._run(self._heartbeat, worker_id, url, capacity, models)
+
+    async def remove(self, worker_id: str):
+        await self._run(self._remove, worker_id)
+
+    async def workers(self) -> list[WorkerInfo]:
+        return await self._run(self._workers)
+
+    async def lease(
+        self, model: str, ttl: float, exclude: Optional[set[str]] = None
+    ) -> Optional[Lease]:
+        return await self._run(self._lease, model, ttl, exclude or set())
+
+    async def release(self, lease_id: str):
+        await self._run(self._release, lease_id)
+
+
+def create_registry(kind: str, path: str, heartbeat_timeout: float) -> WorkerRegistry:
+    if kind == "memory":
+        return MemoryRegistry(heartbeat_timeout)
+    if kind == "sqlite":
+        return SqliteRegistry(path, heartbeat_timeout)
+    raise ValueError("Invalid registry. Currently only supported memory and sqlite")
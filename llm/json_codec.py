@@ -0,0 +1,38 @@
+"""JSON encoding and decoding with the fastest backend installed.
+
+orjson or msgspec are used when available, otherwise the standard library.
+All backends produce compact UTF-8 JSON so the output does not depend on
+which one is installed.
+"""
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+except ImportError:
+    try:
+        import msgspec
+
+        BACKEND = "msgspec"
+        _encoder = msgspec.json.Encoder()
+        _decoder = msgspec.json.Decoder()
+
+        def dumps(obj) -> str:
+            return _encoder.encode(obj).decode()
+
+        loads = _decoder.decode
+    except ImportError:
+        import json
+
+        BACKEND = "json"
+        _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+        def dumps(obj) -> str:
+            return _encoder.encode(obj)
+
+        loads = json.loads
@@ -1,4 +1,5 @@
 import platform
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
@@ -18,11 +19,25 @@ def create_api(app):
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     from llm.provider_manager import provider_manager
+    from llm.scheduler import scheduler
 
-    await provider_manager.start_all()
+    # 在后台启动浏览器，服务先开始监听，每准备好一个页面就多接收一个请求
+    start_task = asyncio.create_task(
+        provider_manager.start_all(on_capacity_change=scheduler.set_capacity)
+    )
+    # 作为worker节点注册到网关
+    gateway_task = None
+    if config.GATEWAY_URL:
+        from llm.gateway.node import report_to_gateway
+
+        gateway_task = asyncio.create_task(report_to_gateway())
     try:
         yield
     finally:
+        start_task.cancel()
+        if gateway_task is not None:
+            gateway_task.cancel()
+            await asyncio.gather(gateway_task, return_exceptions=True)
         # Teardown logic here (after yield)
         # If you have any teardown process, place it here. For example:
         # await close_db_connection()
@@ -42,7 +57,24 @@ def start_xvfb_display():
 
 
 def api():
-    from llm.shared_cmd_options import cmd_opts
+    from llm.shared_cmd_options import cmd_opts, parser
+
+    port = cmd_opts.port if cmd_opts.port else 5000
+    if cmd_opts.gateway and cmd_opts.workers > 1:
+        parser.error("--gateway can not be used together with --workers")
+    if cmd_opts.workers > 1:
+        from llm.supervisor import run_supervisor
+
+        args = ["--timeout-keep-alive", str(cmd_opts.timeout_keep_alive)]
+        if cmd_opts.api_log:
+            args.append("--api-log")
+        run_supervisor(cmd_opts.workers, port, cmd_opts.timeout_keep_alive, args)
+        return
+    if cmd_opts.gateway:
+        from llm.gateway.app import run_gateway
+
+        run_gateway(port, cmd_opts.timeout_keep_alive)
+        return
 
     app = FastAPI(lifespan=lifespan)
     api = create_api(app)
@@ -51,10 +83,12 @@ def api():
         logger.info(f"Start xvfb service")
         start_xvfb_display()
 
-    api.launch(
-        server_name="0.0.0.0" if cmd_opts.listen else "0.0.0.0",
-        port=cmd_opts.port if cmd_opts.port else 5000,
-    )
+    # worker进程只接收调度进程转发的请求
+    if cmd_opts.worker_index is not None:
+        server_name = "127.0.0.1"
+    else:
+        server_name = "0.0.0.0" if cmd_opts.listen else "0.0.0.0"
+    api.launch(server_name=server_name, port=port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,256 @@
+"""In-process metrics rendered in the Prometheus text format.
+
+Recording a value is a dict lookup and an addition, cheap enough to stay on
+under full load. Gauges can be backed by a function that is only called when
+/metrics is scraped.
+"""
+
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 180)
+RATE_BUCKETS = (10, 25, 50, 100, 200, 400, 800, 1600, 3200)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+
+    def render(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, value in list(self._values.items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._function: Optional[Callable[[], Iterable[tuple[dict, float]]]] = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], Iterable[tuple[dict, float]]]):
+        """Compute the samples when scraped, `function` yields (labels, value)"""
+        self._function = function
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        if self._function:
+            samples = [(self._key(labels), value) for labels, value in self._function()]
+        else:
+            samples = list(self._values.items())
+        for key, value in samples:
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签: [各个桶的计数..., +Inf桶的计数, sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, counts in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames, key, f'le="{_format_value(bound)}"'
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.register(
+    Counter(
+        "llm_requests_total",
+        "Chat completion requests by model and HTTP status, error for error answers",
+        ["model", "status"],
+    )
+)
+COMPLETIONS = registry.register(
+    Counter(
+        "llm_completions_total",
+        "Finished completions by model and finish reason",
+        ["model", "finish_reason"],
+    )
+)
+TIME_TO_FIRST_TOKEN = registry.register(
+    Histogram(
+        "llm_time_to_first_token_seconds",
+        "Time from the start of a completion to its first delta",
+        ["model"],
+    )
+)
+COMPLETION_LATENCY = registry.register(
+    Histogram(
+        "llm_completion_duration_seconds",
+        "End to end duration of a completion",
+        ["model"],
+    )
+)
+STREAM_RATE = registry.register(
+    Histogram(
+        "llm_stream_chars_per_second",
+        "Characters per second streamed after the first delta",
+        ["model"],
+        buckets=RATE_BUCKETS,
+    )
+)
+QUEUE_WAIT = registry.register(
+    Histogram(
+        "llm_queue_wait_seconds",
+        "Time a request waited in the admission queue",
+    )
+)
+UPSTREAM_STATUS = registry.register(
+    Counter(
+        "llm_upstream_responses_total",
+        "Status codes of upstream conversation requests",
+        ["path", "status"],
+    )
+)
+LOGINS = registry.register(
+    Counter("llm_logins_total", "Login flows run on a page", ["reason"])
+)
+CLOUDFLARE_BYPASS = registry.register(
+    Counter(
+        "llm_cloudflare_bypass_total",
+        "Cloudflare challenges met by result",
+        ["result"],
+    )
+)
+CACHE = registry.register(
+    Counter("llm_cache_lookups_total", "Response cache lookups by result", ["result"])
+)
+COALESCED = registry.register(
+    Counter(
+        "llm_coalesced_requests_total",
+        "Requests served from an identical request already in flight",
+    )
+)
+MODEL_SWITCHES = registry.register(
+    Counter(
+        "llm_model_switches_total",
+        "Model menu switches on a page by reason",
+        ["reason"],
+    )
+)
+BLOCKED_REQUESTS = registry.register(
+    Counter(
+        "llm_blocked_requests_total",
+        "Page requests aborted by the resource blocker",
+        ["resource_type"],
+    )
+)
+PAGE_RECYCLES = registry.register(
+    Counter(
+        "llm_page_recycles_total",
+        "Pages replaced by the watchdog by reason",
+        ["reason"],
+    )
+)
+THREADS = registry.register(
+    Counter(
+        "llm_thread_lookups_total",
+        "Multi-turn requests by whether an upstream conversation was continued",
+        ["result"],
+    )
+)
+PAGES = registry.register(
+    Gauge("llm_pages", "Browser pages by account and state", ["account", "state"])
+)
+QUEUE = registry.register(Gauge("llm_queue", "Admission queue state", ["state"]))
@@ -0,0 +1,84 @@
+import gzip
+import json
+import os
+import time
+import uuid
+from typing import AsyncIterator, Optional
+
+from llm.logger import logger
+
+
+class StreamCapture:
+    """Save a raw upstream conversation response for replay.
+
+    The body is written gzipped to <name>.sse.gz exactly as received,
+    heartbeats and error events included. The request, status and chunk
+    sizes go to <name>.json next to it.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        path: str,
+        status: int,
+        model: Optional[str],
+        messages: Optional[list[dict]],
+    ):
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{status}-{uuid.uuid4().hex[:8]}"
+        self.body_path = os.path.join(directory, f"{name}.sse.gz")
+        self.meta_path = os.path.join(directory, f"{name}.json")
+        self.meta = {
+            "path": path,
+            "status": status,
+            "model": model,
+            "messages": messages or [],
+            "captured_at": time.time(),
+        }
+        self.chunks: list[int] = []
+        self._file = gzip.open(self.body_path, "wb")
+
+    def write(self, chunk: bytes):
+        if self._file is None:
+            return
+        try:
+            self._file.write(chunk)
+            self.chunks.append(len(chunk))
+        except OSError as e:
+            logger.error(f"[StreamCapture.write] Stop capturing: {str(e)}")
+            self.close()
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self.meta["chunks"] = self.chunks
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+
+    async def tee(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in chunks:
+                self.write(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+
+def load_capture(body_path: str) -> tuple[list[bytes], dict]:
+    """Read a capture back as the chunks it arrived in and its metadata"""
+    with gzip.open(body_path, "rb") as f:
+        body = f.read()
+    meta_path = body_path[: -len(".sse.gz")] + ".json"
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+
+    chunks = []
+    pos = 0
+    for size in meta.get("chunks") or [len(body)]:
+        chunks.append(body[pos : pos + size])
+        pos += size
+    if pos < len(body):
+        chunks.append(body[pos:])
+    return chunks, meta
@@ -1,17 +1,33 @@
 import asyncio
-import json
-import random
-import re
 import time
-from typing import Optional
+from contextlib import aclosing
+from typing import Callable, Optional
 from urllib.parse import urlparse
 
 import httpx
 from playwright.async_api import Page, Response
 
-from llm import config
+from llm import config, metrics, timing
 from llm.logger import logger
+from llm.provider.openai.capture import StreamCapture
+from llm.provider.openai.delta import CompletionStream, DeltaTracker
+from llm.provider.openai.encoder import (
+    ChunkEncoder,
+    completion_response,
+    generate_completion_id,
+)
 from llm.provider.openai.login import OpenAILogin
+from llm.provider.openai.request_template import RequestTemplate
+from llm.provider.openai.session_store import SessionStore
+from llm.provider.openai.sse import SSEDecoder
+from llm.provider.openai.thread_index import Thread, ThreadIndex
+from llm.streaming import ClosingIterator
+
+MODEL_MAP = {
+    "gpt-3.5-turbo": "text-davinci-002-render-sha",
+    "gpt-4": "gpt-4",
+    "gpt-4o": "gpt-4o",
+}
 
 
 class OpenAIClient:
@@ -20,11 +36,18 @@ class OpenAIClient:
         timeout=180,
         *,
         playwright_page: Page,
+        email: Optional[str] = None,
+        password: Optional[str] = None,
+        request_template: Optional[RequestTemplate] = None,
+        session_store: Optional[SessionStore] = None,
+        thread_index: Optional[ThreadIndex] = None,
     ):
         self.timeout = timeout
-        self._host = "https://sharegpt.new.oaifree.com"
+        self._host = config.OPENAI_HOST
         self.playwright_page = playwright_page
-        
+        self.email = email if email is not None else config.OPENAI_LOGIN_EMAIL
+        self.password = password if password is not None else config.OPENAI_LOGIN_PASSWORD
+
         # 调试：确认未使用代理
         logger.info("Initializing OpenAIClient without proxy")
         
@@ -34,28 +57,97 @@ class OpenAIClient:
 
         self.lock = asyncio.Lock()
 
+        # 同一个帐号的页面共享请求模板
+        self.request_template = request_template or RequestTemplate(
+            ttl=config.OPENAI_FAST_PATH_TTL
+        )
+        # 登录后保存会话，重启时恢复
+        self.session_store = session_store
+        # 同一个帐号的页面共享对话索引，多轮对话接着上游已有的对话发送
+        self.thread_index = thread_index
+        self.thread: Optional[Thread] = None
+        self.new_messages = None
+
         self.response_stream = None
         self.messages = None
         self.ready_to_read = asyncio.Event()  # 事件：通知开始读取
         self.read_complete = asyncio.Event()  # 事件：通知读取完成
-        self.origin_response = []
+        self.page_ready = asyncio.Event()  # 事件：上一次对话结束后页面已重置
+        self.page_ready.set()
+        self.reset_task: Optional[asyncio.Task] = None
+        # 页面已经在后台打开了新对话并选好了模型，下一次提问不需要再准备
+        self.fresh_conversation = False
+        # 最近一次请求的模型，后台准备新对话时预先选好
+        self.last_model: Optional[str] = None
+        # 页面处理过的对话数，超过限制后页面会被替换
+        self.conversations = 0
+        # 当前请求的分段计时，__handle_route在页面的回调里运行，拿不到请求的上下文
+        self.timer: Optional[timing.StageTimer] = None
 
         # 登录账户类型，如果是免费用户，没有切换模型的必要
         self.account_type = None
         # gpt-4o, gpt-4, text-davinci-002-render-sha
         self.current_model = None
 
-    async def post_init(self):
+    async def post_init(self, login_first_site: bool = True):
         await self.setup_listener()
         await self.setup_route()
-        
-        # 打开登录页面并进行登录
-        await self.playwright_page.goto("http://60.205.200.121:40/")
-        await self.login_to_first_site()
+
+        # 只有email登录并且有保存的会话时才检查，否则直接登录，不多打开一次页面
+        on_host = False
+        if (
+            config.OPENAI_LOGIN_TYPE == "email"
+            and self.session_store is not None
+            and self.session_store.load()
+        ):
+            # 恢复的会话仍然有效时，不需要再走登录流程
+            await self.playwright_page.goto(self._host)
+            on_host = True
+            if await self.probe_session():
+                logger.info("[OpenAIClient.post_init] Session is valid, skip login")
+                # 保存浏览器中已经续期的cookie和新的过期时间
+                await self.save_session()
+                return
+
+        # 同一个浏览器上下文共享cookie，只有第一个页面需要登录
+        if login_first_site and config.OPENAI_FIRST_SITE_URL:
+            # 打开登录页面并进行登录
+            await self.playwright_page.goto(config.OPENAI_FIRST_SITE_URL)
+            await self.login_to_first_site()
+            on_host = False
 
         # 登录完成后，导航到OpenAI主机
-        await self.playwright_page.goto(self._host)
-        await self.login()
+        if not on_host:
+            await self.playwright_page.goto(self._host)
+        await self.login("startup")
+
+    async def probe_session(self) -> bool:
+        """Check the session with one API request instead of the login UI"""
+        # 未登录模式的登录流程只是关闭弹窗，不需要检查
+        if config.OPENAI_LOGIN_TYPE != "email":
+            return False
+        try:
+            if await self.playwright_page.query_selector("#challenge-form"):
+                return False
+            response = await self.playwright_page.request.get(
+                f"{self._host}/api/auth/session", timeout=10_000
+            )
+            if not response.ok:
+                return False
+            session = await response.json()
+        except Exception as e:
+            logger.info(f"[OpenAIClient.probe_session] Probe failed: {str(e)}")
+            return False
+        return bool(session and session.get("accessToken"))
+
+    async def save_session(self):
+        if not self.session_store:
+            return
+        try:
+            storage_state = await self.playwright_page.context.storage_state()
+            self.session_store.save(storage_state)
+        except Exception as e:
+            logger.error(f"[OpenAIClient.save_session] Fail to save session: {str(e)}")
 
     async def login_to_first_site(self):
         # 填充登录表单
@@ -65,14 +157,16 @@ class OpenAIClient:
         # 提交登录表单
         await self.playwright_page.click("button[type='submit']")
 
-    async def login(self):
+    async def login(self, reason: str = "relogin"):
+        metrics.LOGINS.inc(reason=reason)
         login_obj = OpenAILogin(
             context_page=self.playwright_page,
             login_type=config.OPENAI_LOGIN_TYPE,
-            email=config.OPENAI_LOGIN_EMAIL,
-            password=config.OPENAI_LOGIN_PASSWORD,
+            email=self.email,
+            password=self.password,
         )
         await login_obj.begin()
+        await self.save_session()
 
     async def __handle_response(self, response: Response):
         path = urlparse(response.url).path
@@ -113,6 +207,9 @@ class OpenAIClient:
             **request.headers,
         }
 
+        self.mark("route")
+        route_handled = False
+        reset_started = False
         try:
             url = (
                 "/backend-api/conversation"
@@ -120,32 +217,37 @@ class OpenAIClient:
                 else "/backend-anon/conversation"
             )
 
-            json_body = request.post_data_json
-            if self.messages and len(self.messages) > 1:
-                json_body["messages"] = [
-                    {
-                        "author": {"role": message["role"]},
-                        "content": {
-                            "content_type": "text",
-                            "parts": [message["content"]],
-                        },
-                    }
-                    for message in self.messages
-                ]
-
-            async with self.http_client.stream(
-                "POST",
-                url,
-                headers=headers,
-                json=json_body,
-            ) as response:
-                response_headers = response.headers
+            thread = self.thread
+            json_body = self.conversation_body(request.post_data_json, thread)
+            response = await self.post_conversation(url, headers, json_body)
+            if thread is not None and 400 <= response.status_code < 500:
+                # 上游的对话已经过期或被删除，忘掉它并作为新对话重新发送一次
+                metrics.UPSTREAM_STATUS.inc(path=url, status=response.status_code)
+                logger.error(
+                    f"[OpenAIClient.__handle_route] Conversation {thread.conversation_id} rejected with status {response.status_code}, start a new one"
+                )
+                await response.aclose()
+                self.drop_thread(thread)
+                thread = None
+                self.new_messages = self.messages
+                json_body = self.conversation_body(request.post_data_json, None)
+                response = await self.post_conversation(url, headers, json_body)
+
+            async with aclosing(response):
+                metrics.UPSTREAM_STATUS.inc(path=url, status=response.status_code)
+                self.mark("upstream_headers")
                 if response.status_code != 200:
+                    await self.capture_body(
+                        response, url, json_body.get("model"), self.messages
+                    )
                     logger.error(
-                        "[OpenAIClient.__handle_route] HTTP request failed with status: ",
-                        response.status_code,
+                        f"[OpenAIClient.__handle_route] HTTP request failed with status: {response.status_code}"
                     )
                     self.ready_to_read.set()
+                    self.request_template.invalidate()
+                    if thread is not None:
+                        self.drop_thread(thread)
+                    route_handled = await self.finish_route(route, abort=True)
                     if response.status_code == 403:
                         message = ""
                         async for _ in response.aiter_text():
@@ -155,34 +257,133 @@ class OpenAIClient:
                         )
                         await self.playwright_page.reload()
                         await self.playwright_page.wait_for_load_state("load")
-                        await self.login()
+                        await self.login("forbidden")
                     raise Exception(
                         "[OpenAIClient.__handle_route] HTTP request failed with status: ",
                         response.status_code,
                     )
 
                 logger.info("[OpenAIClient.__handle_route] Conversation response is ok")
-                self.response_stream = response.aiter_text()
+                self.request_template.capture(url, headers, json_body)
+                self.response_stream = self.capture_stream(
+                    response, url, json_body.get("model"), self.messages
+                )
                 self.ready_to_read.set()
 
+                # 回答直接交给客户端，页面上的请求马上结束，不需要保存完整的回答
+                route_handled = await self.finish_route(route)
+
+                # 页面已经空闲，在回答输出的同时准备下一次对话
+                self.reset_task = asyncio.create_task(self.reset_page())
+                reset_started = True
+
                 await asyncio.wait_for(self.read_complete.wait(), timeout=self.timeout)
         except asyncio.TimeoutError:
             logger.error(
                 "[OpenAIClient.__handle_route] Timeout while waiting for read completion"
             )
         finally:
-            logger.info("[OpenAIClient.__handle_route] Write response to page")
-            self.origin_response.append("data: [DONE]\n\n")
-
-            response_body = "".join([f"{_}\n\n" for _ in self.origin_response])
-            await route.fulfill(
-                status=response.status_code,
-                headers=dict(response_headers),
-                body=response_body,
+            if not route_handled:
+                await self.finish_route(route, abort=True)
+
+            # 在后台开启新对话，不占用当前请求的时间
+            if not reset_started:
+                self.reset_task = asyncio.create_task(self.reset_page())
+
+    def conversation_body(self, json_body: dict, thread: Optional[Thread]) -> dict:
+        """The page's conversation request, continuing `thread` when given"""
+        json_body = dict(json_body)
+        if thread is not None:
+            # 接着上游已有的对话，只发送新的消息
+            json_body["conversation_id"] = thread.conversation_id
+            json_body["parent_message_id"] = thread.message_id
+        send_messages = self.new_messages if thread is not None else self.messages
+        if send_messages and len(send_messages) > 1:
+            json_body["messages"] = [
+                {
+                    "author": {"role": message["role"]},
+                    "content": {
+                        "content_type": "text",
+                        "parts": [message["content"]],
+                    },
+                }
+                for message in send_messages
+            ]
+        return json_body
+
+    async def post_conversation(
+        self, url: str, headers: dict, json_body: dict
+    ) -> httpx.Response:
+        request = self.http_client.build_request(
+            "POST", url, headers=headers, json=json_body
+        )
+        return await self.http_client.send(request, stream=True)
+
+    def capture_stream(
+        self,
+        response: httpx.Response,
+        path: str,
+        model: Optional[str],
+        messages: Optional[list[dict]],
+    ):
+        if not config.OPENAI_CAPTURE_DIR:
+            return response.aiter_bytes()
+        capture = StreamCapture(
+            config.OPENAI_CAPTURE_DIR, path, response.status_code, model, messages
+        )
+        return capture.tee(response.aiter_bytes())
+
+    async def capture_body(
+        self,
+        response: httpx.Response,
+        path: str,
+        model: Optional[str],
+        messages: Optional[list[dict]],
+    ):
+        """Capture a whole error response, it can still be read afterwards"""
+        if not config.OPENAI_CAPTURE_DIR:
+            return
+        body = await response.aread()
+        capture = StreamCapture(
+            config.OPENAI_CAPTURE_DIR, path, response.status_code, model, messages
+        )
+        capture.write(body)
+        capture.close()
+
+    async def finish_route(self, route, abort: bool = False) -> bool:
+        try:
+            if abort:
+                await route.abort()
+            else:
+                await route.fulfill(
+                    status=200,
+                    content_type="text/event-stream",
+                    body="data: [DONE]\n\n",
+                )
+        except Exception as e:
+            logger.info(
+                f"[OpenAIClient.finish_route] Fail to finish the page request: {str(e)}"
             )
+        return True
 
-            # 开启新对话
+    async def reset_page(self):
+        """Open a blank conversation on the last used model for the next prompt"""
+        try:
             await self.new_conversation()
+            if self.last_model:
+                await self.change_model(self.last_model, reason="reset")
+            self.fresh_conversation = True
+        except Exception as e:
+            logger.error(f"[OpenAIClient.reset_page] Fail to reset page: {str(e)}")
+        finally:
+            self.page_ready.set()
+
+    async def close(self):
+        """Close the page once it is out of the pool"""
+        if self.reset_task and not self.reset_task.done():
+            self.reset_task.cancel()
+        await self.http_client.aclose()
+        await self.playwright_page.close()
 
     async def setup_route(self):
         # for nologin
@@ -194,253 +395,374 @@ class OpenAIClient:
             "**/backend-api/conversation", self.__handle_route
         )
 
-    def generate_completion_id(self, prefix="cmpl-"):
-        characters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
-        length = 28
+    def mark(self, stage: str):
+        if self.timer is not None:
+            self.timer.mark(stage)
 
-        random_chars = [random.choice(characters) for _ in range(length)]
-        return prefix + "".join(random_chars)
+    def generate_completion_id(self, prefix="cmpl-"):
+        return generate_completion_id(prefix)
 
-    async def chunks_to_lines(self, chunks_async):
-        previous = ""
+    @staticmethod
+    async def chunks_to_lines(chunks_async):
+        decoder = SSEDecoder()
         async for chunk in chunks_async:
-            buffer_chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
-            previous += buffer_chunk
-            eol_index = 0
-            while (eol_index := previous.find("\n")) >= 0:
-                line = previous[: eol_index + 1].strip()
-                if line == "data: [DONE]":
-                    break
-                if line.startswith("data: "):
-                    self.origin_response.append(line)
-                    yield line
-                previous = previous[eol_index + 1 :]
-
-    async def lines_to_messages(self, lines_async):
-        async for line in lines_async:
-            message = line[len("data: ") :]
-            yield message
+            for event in decoder.feed(chunk):
+                yield event
+            if decoder.done:
+                return
+        for event in decoder.close():
+            yield event
+
+    @staticmethod
+    async def lines_to_messages(lines_async):
+        async for event in lines_async:
+            yield event.data
 
     async def stream_completion(self, data):
         async for message in self.lines_to_messages(self.chunks_to_lines(data)):
             yield message
 
     async def create_completion(
-        self, model: str, messages: list[dict[str, any]], stream: Optional[bool] = False
+        self,
+        model: str,
+        messages: list[dict[str, any]],
+        stream: Optional[bool] = False,
+        on_finish: Optional[Callable[[CompletionStream], None]] = None,
+        on_delta: Optional[Callable[[str, str], None]] = None,
     ) -> dict[str, any]:
 
-        try:
-            await asyncio.wait_for(self.lock.acquire(), timeout=1)
-        except TimeoutError:
-            message = {
-                "status": False,
-                "error": {
-                    "message": "Too many requests. please slow down.",
-                    "type": "invalid_request_error",
-                },
-                "support": "https://github.com/adryfish/llm-web-api",
-            }
-            logger.error(message)
-            raise Exception("Too many requests. please slow down.")
+        # 页面池每次只把页面交给一个请求，这里不会等待
+        await self.lock.acquire()
 
         logger.info("[OpenAIClient.create_completion] Start chat_completion")
+        started = time.perf_counter()
+        self.timer = timing.current_timer.get()
+        self.mark("page_lock")
+        self.conversations += 1
+        # 流式输出时，锁在generator结束后才释放
+        release_lock = True
         self.response_stream = None
         self.messages = None
         self.ready_to_read.clear()
         self.read_complete.clear()
-        self.origin_response = []
+        self.find_thread(messages)
         try:
-            if config.OPENAI_LOGIN_TYPE == "email":
+            if config.OPENAI_FAST_PATH and self.request_template.is_valid():
+                self.response_stream = await self.send_direct(model, messages)
+                self.mark("direct_request")
+
+            if self.response_stream:
+                logger.info("[OpenAIClient.create_completion] Use request template")
+                self.messages = messages
+            else:
+                await self.submit_prompt(model, messages)
+
+            completion = await self.build_completion(
+                model,
+                messages,
+                stream,
+                started=started,
+                on_finish=on_finish,
+                on_delta=on_delta,
+            )
+            if stream:
+                release_lock = False
+            return completion
+        except TimeoutError as e:
+            logger.error("[OpenAIClient.chat_completion] wait timeout")
+            await self.playwright_page.reload()
+            await self.login("timeout")
+        except Exception as e:
+            logger.error(f"[OpenAIClient.chat_completion] Error happened: {str(e)}")
+            raise e
+        finally:
+            if release_lock:
+                self.lock.release()
+
+    async def submit_prompt(self, model: str, messages: list[dict[str, any]]):
+        """Type the prompt into the page and wait for __handle_route to take over"""
+        # 等待上一次回答结束后的页面重置完成
+        await self.page_ready.wait()
+        self.page_ready.clear()
+        self.mark("page_ready")
+        try:
+            await self.type_prompt(model, messages)
+        except BaseException:
+            # __handle_route没有接管页面时，由这里恢复页面状态
+            if not self.ready_to_read.is_set():
+                self.page_ready.set()
+            raise
+
+    async def type_prompt(self, model: str, messages: list[dict[str, any]]):
+        self.last_model = model
+        if config.OPENAI_LOGIN_TYPE == "email":
+            # 后台已经准备好新对话时跳过，模型不同时仍需切换
+            if not self.fresh_conversation:
                 await self.new_conversation()
-                await self.change_model(model)
+            self.mark("new_conversation")
+            await self.change_model(model)
+            self.mark("change_model")
+        self.fresh_conversation = False
 
-            prompt_textarea = self.playwright_page.locator("#prompt-textarea")
+        prompt_textarea = self.playwright_page.locator("#prompt-textarea")
 
-            content = self.message_prepare(messages)
-            await prompt_textarea.click()
-            await prompt_textarea.fill(content)
+        content = self.message_prepare(messages)
+        await prompt_textarea.click()
+        await prompt_textarea.fill(content)
+        self.mark("fill")
 
-            submit_button = self.playwright_page.locator(
-                'button[data-testid="fruitjuice-send-button"], button[data-testid="send-button"]'
-            )
-            if await submit_button.count() == 1 and await submit_button.is_visible():
+        submit_button = self.playwright_page.locator(
+            'button[data-testid="fruitjuice-send-button"], button[data-testid="send-button"]'
+        )
+        if await submit_button.count() == 1 and await submit_button.is_visible():
+            await submit_button.click()
+        else:
+            form = self.playwright_page.locator("form")
+            buttons = form.locator("button")
+            button_count = await buttons.count()
+            submit_button = buttons.nth(button_count - 1)
+            if await submit_button.is_visible():
                 await submit_button.click()
             else:
-                form = self.playwright_page.locator("form")
-                buttons = form.locator("button")
-                button_count = await buttons.count()
-                submit_button = buttons.nth(button_count - 1)
-                if await submit_button.is_visible():
-                    await submit_button.click()
-                else:
-                    raise Exception(
-                        "[OpenAIClient.create_completion] Cannot submit the content"
-                    )
-
-            await asyncio.wait_for(self.ready_to_read.wait(), timeout=self.timeout)
-
-            if not self.response_stream:
                 raise Exception(
-                    "[OpenAIClient.create_completion] response stream is None"
+                    "[OpenAIClient.create_completion] Cannot submit the content"
                 )
+        self.mark("submit")
 
-            full_content = ""
-            error = None
-            finish_reason = None
-            request_id = self.generate_completion_id("chatcmpl-")
-            created = int(time.time())
-            content_chunks = []
-            final_model = model
-
-            async def generator():
-                nonlocal full_content
-                nonlocal error
-                nonlocal finish_reason
-                nonlocal final_model
-                nonlocal created
-                async for message in self.stream_completion(self.response_stream):
-                    if re.match(
-                        r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}$", message
-                    ):
-                        continue
-
-                    parsed = json.loads(message)
-                    if parsed.get("error"):
-                        error = f"Error message from OpenAI: {parsed['error']}"
-                        finish_reason = "stop"
-                        break
-
-                    content = (
-                        parsed.get("message", {})
-                        .get("content", {})
-                        .get("parts", [""])[0]
-                    )
-                    status = parsed.get("message", {}).get("status", "")
+        await asyncio.wait_for(self.ready_to_read.wait(), timeout=self.timeout)
 
-                    for msg in messages:
-                        if msg["content"] == content:
-                            content = ""
-                            break
+        if not self.response_stream:
+            raise Exception(
+                "[OpenAIClient.create_completion] response stream is None"
+            )
 
-                    if not content:
-                        continue
+    async def send_direct(self, model: str, messages: list[dict[str, any]]):
+        """Post the conversation with the captured request template"""
+        model_slug = (
+            MODEL_MAP.get(model) if self.account_type == "chatgpt-paid" else None
+        )
+        path = self.request_template.path
+        json_body = self.request_template.render(
+            self.new_messages, model_slug, self.thread
+        )
+        request = self.http_client.build_request(
+            "POST", path, headers=self.request_template.headers, json=json_body
+        )
+        try:
+            response = await self.http_client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            logger.error(f"[OpenAIClient.send_direct] Request failed: {str(e)}")
+            self.request_template.invalidate()
+            return None
+
+        metrics.UPSTREAM_STATUS.inc(path=path, status=response.status_code)
+        if response.status_code != 200:
+            await self.capture_body(response, path, json_body.get("model"), messages)
+            logger.info(
+                f"[OpenAIClient.send_direct] Template rejected with status: {response.status_code}"
+            )
+            await response.aclose()
+            self.request_template.invalidate()
+            # 上游可能不再接受这个对话，回到页面发送时从新对话开始
+            if self.thread is not None:
+                self.drop_thread(self.thread)
+                self.new_messages = messages
+            return None
 
-                    completion_chunk = content.replace(full_content, "")
-                    full_content = (
-                        content if len(content) > len(full_content) else full_content
-                    )
-                    content_chunks.append(completion_chunk)
+        chunks = self.capture_stream(response, path, json_body.get("model"), messages)
 
-                    final_model = (
-                        parsed.get("message", {})
-                        .get("metadata", {})
-                        .get("model_slug", final_model)
-                    )
+        async def iter_response():
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            finally:
+                await response.aclose()
 
-                    if status == "finished_successfully":
-                        finish_details_type = (
-                            parsed.get("message", {})
-                            .get("metadata", {})
-                            .get("finish_details", {})
-                            .get("type")
-                        )
+        return iter_response()
+
+    async def build_completion(
+        self,
+        model: str,
+        messages: list[dict[str, any]],
+        stream: Optional[bool] = False,
+        started: Optional[float] = None,
+        on_finish: Optional[Callable[[CompletionStream], None]] = None,
+        on_delta: Optional[Callable[[str, str], None]] = None,
+    ):
+        """Turn self.response_stream into an OpenAI compatible response.
+
+        on_delta is called with every delta and the current model, on_finish
+        with the finished CompletionStream when the answer ended without an
+        error.
+        """
+        started = started or time.perf_counter()
+        first_token = None
+        # 只有发送出去的消息会被回显
+        completion_stream = CompletionStream(
+            [msg["content"] for msg in self.new_messages or messages], model
+        )
+        request_id = self.generate_completion_id("chatcmpl-")
+        created = int(time.time())
+        encoder = ChunkEncoder(request_id, created, model)
 
-                        if finish_details_type == "max_tokens":
-                            finish_reason = "length"
-                        else:
-                            finish_reason = "stop"
-                        break
+        async def generator():
+            nonlocal first_token
+            try:
+                async for completion_chunk in completion_stream.deltas(
+                    self.stream_completion(self.response_stream)
+                ):
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        self.mark("first_token")
+                        metrics.TIME_TO_FIRST_TOKEN.observe(
+                            first_token - started, model=model
+                        )
 
+                    if on_delta:
+                        on_delta(completion_chunk, completion_stream.model)
                     if stream:
-                        response_chunk = {
-                            "id": request_id,
-                            "created": created,
-                            "object": "chat.completion.chunk",
-                            "model": final_model,
-                            "choices": [
-                                {
-                                    "delta": {"content": completion_chunk},
-                                    "index": 0,
-                                    "finish_reason": finish_reason,
-                                }
-                            ],
-                        }
-                        yield f"data: {json.dumps(response_chunk)}\n\n"
+                        yield encoder.encode(
+                            completion_chunk, model=completion_stream.model
+                        )
 
                 logger.info("[OpenAIClient.create_completion] End chat_completion")
+                self.mark("stream")
                 self.read_complete.set()
+                error = completion_stream.error
+                finish_reason = completion_stream.finish_reason
+                self.observe_completion(
+                    model,
+                    started,
+                    first_token,
+                    completion_stream.tracker,
+                    error,
+                    finish_reason,
+                )
+                if not error and finish_reason:
+                    self.remember_thread(messages, completion_stream)
+                    if on_finish:
+                        on_finish(completion_stream)
 
                 if stream:
-                    data = {
-                        "id": request_id,
-                        "created": created,
-                        "object": "chat.completion.chunk",
-                        "model": final_model,
-                        "choices": [
-                            {
-                                "delta": {"content": error if error else ""},
-                                "index": 0,
-                                "finish_reason": finish_reason,
-                            }
-                        ],
-                    }
-                    yield f"data: {json.dumps(data)}\n\n"
+                    yield encoder.encode(
+                        error if error else "",
+                        finish_reason,
+                        model=completion_stream.model,
+                    )
                     yield f"data: [DONE]\n\n"
                 else:
-                    response_data = {
-                        "id": request_id,
-                        "model": final_model,
-                        "object": "chat.completion",
-                        "choices": [
-                            {
-                                "message": {
-                                    "role": "assistant",
-                                    "content": error if error else full_content,
-                                },
-                                "index": 0,
-                                "finish_reason": finish_reason,
-                            }
-                        ],
-                        "usage": {
-                            "prompt_tokens": 1,
-                            "completion_tokens": 1,
-                            "total_tokens": 2,
-                        },
-                        "created": created,
-                    }
-
-                    yield response_data
+                    yield completion_response(
+                        request_id,
+                        created,
+                        completion_stream.model,
+                        error if error else completion_stream.tracker.content,
+                        finish_reason,
+                    )
+            finally:
+                # 客户端中途断开时也要通知__handle_route结束
+                self.read_complete.set()
 
-            if stream:
-                return generator()
+        if stream:
+            # 回答还没有开始输出时客户端就断开，也要释放页面
+            return ClosingIterator(generator(), self.end_stream)
 
-            async for _ in generator():
-                return _
-        except TimeoutError as e:
-            logger.error("[OpenAIClient.chat_completion] wait timeout")
-            await self.playwright_page.reload()
-            await self.login()
-        except Exception as e:
-            logger.error("[OpenAIClient.chat_completion] Error happened")
-            print(e)
-            raise e
-        finally:
-            self.lock.release()
+        async for _ in generator():
+            return _
+
+    def end_stream(self):
+        self.read_complete.set()
+        self.lock.release()
+
+    def find_thread(self, messages: list[dict[str, any]]):
+        """Look up the upstream conversation this request continues"""
+        self.thread = None
+        self.new_messages = messages
+        # 至少要有一轮问答和一条新消息
+        if self.thread_index is None or len(messages) < 3:
+            return
+        found = self.thread_index.find(messages)
+        metrics.THREADS.inc(result="continued" if found else "new")
+        if found:
+            self.thread, self.new_messages = found
+            logger.info(
+                f"[OpenAIClient.find_thread] Continue conversation {self.thread.conversation_id} with {len(self.new_messages)} new messages"
+            )
+
+    def drop_thread(self, thread: Thread):
+        self.thread_index.discard(thread)
+        self.thread = None
+
+    def remember_thread(
+        self, messages: list[dict[str, any]], completion_stream: CompletionStream
+    ):
+        if (
+            self.thread_index is None
+            or not completion_stream.conversation_id
+            or not completion_stream.message_id
+        ):
+            return
+        self.thread_index.put(
+            messages,
+            completion_stream.content,
+            Thread(completion_stream.conversation_id, completion_stream.message_id),
+        )
+
+    def observe_completion(
+        self,
+        model: str,
+        started: float,
+        first_token: Optional[float],
+        tracker: DeltaTracker,
+        error: Optional[str],
+        finish_reason: Optional[str],
+    ):
+        finished = time.perf_counter()
+        metrics.COMPLETION_LATENCY.observe(finished - started, model=model)
+        metrics.COMPLETIONS.inc(
+            model=model, finish_reason="error" if error else finish_reason or "none"
+        )
+        if first_token is not None and finished > first_token:
+            metrics.STREAM_RATE.observe(
+                tracker.emitted / (finished - first_token), model=model
+            )
 
     def message_prepare(self, messages: list[dict[str, any]]):
         self.messages = messages
         return messages[-1].get("content")
 
-    async def change_model(self, model_name: str):
+    @property
+    def can_switch_model(self) -> bool:
+        """Only paid accounts have the model menu"""
+        return self.account_type == "chatgpt-paid"
+
+    @property
+    def page_model(self) -> Optional[str]:
+        """The model selected on the page, by its API name"""
+        for name, slug in MODEL_MAP.items():
+            if slug == self.current_model:
+                return name
+        return None
+
+    def needs_model_switch(self, model_name: Optional[str]) -> bool:
+        return (
+            self.can_switch_model
+            and model_name is not None
+            and MODEL_MAP.get(model_name) != self.current_model
+        )
+
+    async def prepare_model(self, model_name: str):
+        """Switch an idle page to another model before a request needs it"""
+        # 之后后台重置页面时也保持这个模型
+        self.last_model = model_name
+        await self.page_ready.wait()
+        await self.change_model(model_name, reason="rebalance")
+
+    async def change_model(self, model_name: str, reason: str = "request"):
         if self.account_type != "chatgpt-paid":
             return
 
-        model_map = {
-            "gpt-3.5-turbo": "text-davinci-002-render-sha",
-            "gpt-4": "gpt-4",
-            "gpt-4o": "gpt-4o",
-        }
-        if model_map.get(model_name) != self.current_model:
+        if MODEL_MAP.get(model_name) != self.current_model:
+            metrics.MODEL_SWITCHES.inc(reason=reason)
             logger.info(
                 f"[OpenAIClient.change_model] Changing model from {self.current_model} to {model_name}"
             )
@@ -466,6 +788,7 @@ class OpenAIClient:
                 button = buttons.nth(index)
                 if (await button.is_visible()):
                     await button.click()
+                    self.current_model = MODEL_MAP.get(model_name)
                     logger.info(
                         f"[OpenAIClient.change_model] Success change model to {model_name}"
                     )
@@ -477,7 +800,7 @@ class OpenAIClient:
             await self.playwright_page.reload()
             return
         url = self.playwright_page.url
-        if (not url.startswith("https://sharegpt.new.oaifree.com")):
+        if (not url.startswith(self._host)):
             await self.playwright_page.goto(self._host)
             return
 
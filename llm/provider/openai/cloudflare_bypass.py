@@ -1,5 +1,7 @@
+import asyncio
 import platform
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 from DrissionPage import ChromiumOptions, ChromiumPage
@@ -7,11 +9,24 @@ from DrissionPage import ChromiumOptions, ChromiumPage
 from llm import config
 from llm.logger import logger
 
+# DrissionPage的调用都是阻塞的，放到单独的线程中执行，同一时间只运行一个
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cloudflare-bypass")
+
+
+class BypassCancelled(Exception):
+    pass
+
 
 class CloudflareBypass:
     def __init__(
-        self, proxy_server: Optional[str] = None, user_agent: Optional[str] = None
+        self,
+        proxy_server: Optional[str] = None,
+        user_agent: Optional[str] = None,
+        cancelled: Optional[threading.Event] = None,
     ):
+        # 超时或被取消时设置，用来代替time.sleep，让等待可以提前结束
+        self.cancelled = cancelled or threading.Event()
+
         browser_path = config.BROWSER_PATH
         if not browser_path:
             os_name = platform.system().lower()
@@ -66,14 +81,14 @@ class CloudflareBypass:
             )
             check_count += 1
 
-            time.sleep(20)
+            self.wait(20)
 
         return self.driver.cookies(all_info=True)
 
     def try_to_click_challenge(self):
         try:
             if self.driver.wait.ele_displayed("xpath://div/iframe", timeout=1.5):
-                time.sleep(1.5)
+                self.wait(1.5)
                 self.driver("xpath://div/iframe").ele(
                     "Verify you are human", timeout=2.5
                 ).click()
@@ -90,6 +105,10 @@ class CloudflareBypass:
             )
             self.driver.refresh()
 
+    def wait(self, seconds: float):
+        if self.cancelled.wait(seconds):
+            raise BypassCancelled("Cloudflare bypass cancelled")
+
     def is_passed(self):
         print(self.driver.cookies())
         for cookie in self.driver.cookies():
@@ -102,3 +121,50 @@ class CloudflareBypass:
             self.driver.close()
         except Exception as e:
             print(e)
+
+
+async def bypass_in_thread(
+    url: str,
+    proxy_server: Optional[str] = None,
+    user_agent: Optional[str] = None,
+    timeout: float = config.CLOUDFLARE_BYPASS_TIMEOUT,
+) -> list[dict]:
+    """Run a whole bypass, browser start to close, in the bypass thread.
+
+    The event loop keeps serving other pages meanwhile. The timeout counts
+    from when the thread picks the bypass up, not while it waits behind the
+    bypass of another page. On timeout or when the awaiting task is cancelled
+    the thread is told to stop and quits at its next wait.
+    """
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    started = loop.create_future()
+
+    def start():
+        if not started.done():
+            started.set_result(None)
+
+    def run():
+        loop.call_soon_threadsafe(start)
+        if cancelled.is_set():
+            raise BypassCancelled("Cloudflare bypass cancelled")
+        cloudflare_bypass = CloudflareBypass(proxy_server, user_agent, cancelled)
+        try:
+            return cloudflare_bypass.bypass(url)
+        finally:
+            cloudflare_bypass.close()
+
+    future = loop.run_in_executor(_executor, run)
+    try:
+        await started
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except BaseException:
+        cancelled.set()
+        future.add_done_callback(log_stopped)
+        raise
+
+
+def log_stopped(future: asyncio.Future):
+    # 线程结束时的BypassCancelled已经没有人等待，取出来避免告警
+    if not future.cancelled() and future.exception():
+        logger.info(f"[bypass_in_thread] Bypass stopped: {str(future.exception())}")
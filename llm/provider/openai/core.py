@@ -1,71 +1,240 @@
+import asyncio
+import json
 import os
-from typing import Optional
+import time
+from typing import AsyncIterator, Callable, Optional
 
-from fastapi.responses import StreamingResponse
 from playwright.async_api import (
     BrowserContext,
     BrowserType,
-    Page,
     Playwright,
     async_playwright,
 )
 
-from llm import config
+from llm import config, timing
 from llm.api.chat import Message
 from llm.base.chat import AbstractChat
 from llm.base.crawler import AbstractCrawler
 from llm.logger import logger
 from llm.provider.openai.client import OpenAIClient
+from llm.provider.openai.page_pool import PagePool
+from llm.provider.openai.page_watchdog import PageWatchdog
+from llm.provider.openai.request_template import RequestTemplate
+from llm.provider.openai.resource_blocker import ResourceBlocker, allowed_hosts
+from llm.provider.openai.session_store import SessionStore
+from llm.provider.openai.thread_index import ThreadIndex
+from llm.streaming import ClosingIterator, ClosingStreamingResponse
+from llm.timing import StageTimer
 
 
 class OpenAICrawler(AbstractCrawler, AbstractChat):
     playwright: Playwright
-    context_page: Page
     browser_context: BrowserContext
-    openai_client: OpenAIClient
+    page_pool: PagePool
 
-    def __init__(self) -> None:
-        self.index_url = "https://sharegpt.new.oaifree.com/"
+    def __init__(
+        self,
+        account_index: int = 0,
+        email: Optional[str] = None,
+        password: Optional[str] = None,
+    ) -> None:
+        self.index_url = config.OPENAI_HOST + "/"
         self.https_proxy = config.PROXY_SERVER
 
+        # 每个帐号使用独立的浏览器数据目录，第一个帐号沿用原来的目录
+        self.account_index = account_index
+        self.email = email
+        self.password = password
+        self.outstanding_requests = 0
+
         if config.OPENAI_LOGIN_TYPE == "nologin":
             self.supported_model = ["gpt-3.5-turbo"]
         else:
             self.supported_model = ["gpt-3.5-turbo", "gpt-4", "gpt-4o"]
 
+        self.page_pool = PagePool()
+        self.request_template = RequestTemplate(ttl=config.OPENAI_FAST_PATH_TTL)
+        # 上游的对话属于登录的帐号，未登录模式不能接着发送
+        self.thread_index = (
+            ThreadIndex(config.OPENAI_THREAD_CACHE_SIZE, config.OPENAI_THREAD_TTL)
+            if config.OPENAI_REUSE_THREADS and config.OPENAI_LOGIN_TYPE == "email"
+            else None
+        )
+
+        # 会话文件和浏览器数据目录同名
+        self.profile_name = (
+            "openai" if account_index == 0 else f"openai-{account_index}"
+        )
+        self.session_store = SessionStore(
+            os.path.join(config.BROWSER_DATA, "sessions", f"{self.profile_name}.json")
+        )
+
+        self.startup_state = "pending"
+        self.startup_error: Optional[str] = None
+        self.startup_timer: Optional[StageTimer] = None
+        self.watchdog: Optional[PageWatchdog] = None
+
     async def start(self) -> None:
-        self.playwright = await async_playwright().start()
-        # Launch a browser context.
-        chromium = self.playwright.chromium
-        self.browser_context = await self.launch_browser(
-            chromium,
-            {"server": self.https_proxy} if self.https_proxy else None,
-            config.USER_AGENT,
-            headless=config.HEADLESS,
+        self.startup_state = "starting"
+        timer = self.startup_timer = StageTimer()
+        try:
+            self.playwright = await async_playwright().start()
+            # Launch a browser context.
+            chromium = self.playwright.chromium
+            self.browser_context = await self.launch_browser(
+                chromium,
+                {"server": self.https_proxy} if self.https_proxy else None,
+                config.USER_AGENT,
+                headless=config.HEADLESS,
+            )
+            self.browser_context.set_default_timeout(180_000)
+            timer.mark("launch_browser")
+            # doesn't work now
+            # stealth.min.js is a js script to prevent the website from detecting the crawler.
+            # await self.browser_context.add_init_script(
+            #     path=os.path.join(os.getcwd(), "libs/stealth.min.js")
+            # )
+            await self.browser_context.add_init_script(
+                "Object.defineProperty(navigator, 'webdriver', {get: () => false});"
+            )
+            if config.BLOCK_RESOURCES:
+                blocker = ResourceBlocker(
+                    config.ALLOWED_RESOURCE_TYPES,
+                    allowed_hosts(config.OPENAI_LOGIN_TYPE),
+                )
+                await blocker.install(self.browser_context)
+            await self.restore_session()
+            timer.mark("restore_session")
+
+            # 第一个页面负责登录，其他页面共用浏览器上下文的cookie，可以同时打开
+            await self.add_client(login_first_site=True)
+            timer.mark("first_page")
+            if config.OPENAI_PAGE_POOL_SIZE > 1:
+                results = await asyncio.gather(
+                    *(
+                        self.add_client(login_first_site=False)
+                        for _ in range(config.OPENAI_PAGE_POOL_SIZE - 1)
+                    ),
+                    return_exceptions=True,
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.error(
+                            f"[OpenAICrawler.start] Fail to open a page of {self.profile_name}: {str(result)}"
+                        )
+                timer.mark("other_pages")
+            self.startup_state = "ready"
+
+            if config.PAGE_WATCHDOG_INTERVAL > 0:
+                self.watchdog = PageWatchdog(
+                    self.page_pool,
+                    lambda: self.new_client(login_first_site=False),
+                    interval=config.PAGE_WATCHDOG_INTERVAL,
+                    max_js_heap=config.PAGE_MAX_JS_HEAP,
+                    max_dom_nodes=config.PAGE_MAX_DOM_NODES,
+                    max_conversations=config.PAGE_MAX_CONVERSATIONS,
+                )
+                self.watchdog.start()
+        except Exception as e:
+            self.startup_state = "failed"
+            self.startup_error = str(e)
+            raise
+        finally:
+            logger.info(
+                f"[OpenAICrawler.start] {self.profile_name} {self.startup_state} with {self.page_pool.size} pages, {timer.summary()}"
+            )
+
+    async def add_client(self, login_first_site: bool):
+        """Open one more page and put it in the pool as soon as it is usable"""
+        ts = time.perf_counter()
+        client = await self.new_client(login_first_site=login_first_site)
+        self.page_pool.add(client)
+        logger.info(
+            f"[OpenAICrawler.add_client] Page {self.page_pool.size} of {self.profile_name} ready in {time.perf_counter() - ts:.1f}s"
+        )
+        if self.on_page_ready:
+            self.on_page_ready()
+
+    def startup_status(self) -> dict:
+        stages = self.startup_timer.stages if self.startup_timer else []
+        return {
+            "account": self.profile_name,
+            "state": self.startup_state,
+            "pages": self.page_pool.size,
+            "target_pages": config.OPENAI_PAGE_POOL_SIZE,
+            "stages": {name: round(duration, 3) for name, duration in stages},
+            "error": self.startup_error,
+        }
+
+    async def restore_session(self):
+        """Load the saved cookies and localStorage into the browser context"""
+        storage_state = self.session_store.load()
+        if not storage_state:
+            return
+
+        if storage_state.get("cookies"):
+            await self.browser_context.add_cookies(storage_state["cookies"])
+        local_storage = {
+            origin["origin"]: [
+                [item["name"], item["value"]] for item in origin.get("localStorage", [])
+            ]
+            for origin in storage_state.get("origins", [])
+        }
+        if local_storage:
+            # 只补充页面上没有的值，不覆盖页面自己写入的
+            await self.browser_context.add_init_script(
+                "(() => { try {"
+                f" const items = {json.dumps(local_storage)}[location.origin] || [];"
+                " for (const [name, value] of items) {"
+                "  if (localStorage.getItem(name) === null) localStorage.setItem(name, value);"
+                " } } catch (e) {} })();"
+            )
+
+        expires_in = (
+            f"{(self.session_store.expires_at - time.time()) / 3600:.1f}h"
+            if self.session_store.expires_at
+            else "unknown"
         )
-        self.browser_context.set_default_timeout(180_000)
-        # doesn't work now
-        # stealth.min.js is a js script to prevent the website from detecting the crawler.
-        # await self.browser_context.add_init_script(
-        #     path=os.path.join(os.getcwd(), "libs/stealth.min.js")
-        # )
-        await self.browser_context.add_init_script(
-            "Object.defineProperty(navigator, 'webdriver', {get: () => false});"
+        logger.info(
+            f"[OpenAICrawler.restore_session] Restored {len(storage_state.get('cookies', []))} cookies of {self.profile_name}, session expires in {expires_in}"
         )
 
-        self.context_page = await self.browser_context.new_page()
-        self.context_page.set_default_timeout(180_000)
+    @property
+    def capacity(self) -> int:
+        return self.page_pool.size
 
-        user_agent = await self.context_page.evaluate("navigator.userAgent")
+    @property
+    def idle_capacity(self) -> int:
+        return self.page_pool.idle_count
+
+    @property
+    def starting(self) -> bool:
+        return self.startup_state in ("pending", "starting")
+
+    def page_stats(self) -> dict[str, int]:
+        return {"idle": self.page_pool.idle_count, "busy": self.page_pool.busy_count}
+
+    async def new_client(self, login_first_site: bool = True) -> OpenAIClient:
+        """Open a new page in the browser context and bind an OpenAIClient to it"""
+        context_page = await self.browser_context.new_page()
+        context_page.set_default_timeout(180_000)
+
+        user_agent = await context_page.evaluate("navigator.userAgent")
         if "HEADLESS" in user_agent:
             logger.warn(
                 "The user-agent contains HEADLESS. Note that this might not bypass Cloudflare challenge."
             )
 
-        self.openai_client = OpenAIClient(
-            playwright_page=self.context_page
+        openai_client = OpenAIClient(
+            playwright_page=context_page,
+            email=self.email,
+            password=self.password,
+            request_template=self.request_template,
+            session_store=self.session_store,
+            thread_index=self.thread_index,
         )
-        await self.openai_client.post_init()
+        await openai_client.post_init(login_first_site=login_first_site)
+        return openai_client
 
     async def launch_browser(
         self,
@@ -76,7 +245,7 @@ class OpenAICrawler(AbstractCrawler, AbstractChat):
     ) -> BrowserContext:
         """Launch browser and create browser context"""
         if config.SAVE_LOGIN_STATE:
-            user_data_dir = os.path.join(config.BROWSER_DATA, "openai")
+            user_data_dir = os.path.join(config.BROWSER_DATA, self.profile_name)
             browser_context = await chromium.launch_persistent_context(
                 user_data_dir=user_data_dir,
                 accept_downloads=True,
@@ -84,7 +253,7 @@ class OpenAICrawler(AbstractCrawler, AbstractChat):
                 proxy=playwright_proxy,
                 # viewport={"width": config.SCREEN_WIDTH, "height": config.SCREEN_HEIGHT},
                 user_agent=user_agent,
-                channel="chrome",
+                channel=config.BROWSER_CHANNEL,
                 # https://peter.sh/experiments/chromium-command-line-switches/
                 # 网上的答案都不对!!!
                 # 隐藏“Chrome is being controlled by automated test software”提示
@@ -95,7 +264,7 @@ class OpenAICrawler(AbstractCrawler, AbstractChat):
             browser = await chromium.launch(
                 headless=headless,
                 proxy=playwright_proxy,
-                channel="chrome",
+                channel=config.BROWSER_CHANNEL,
                 ignore_default_args=["--enable-automation"],
             )
             browser_context = await browser.new_context(
@@ -106,31 +275,75 @@ class OpenAICrawler(AbstractCrawler, AbstractChat):
 
     async def stop(self) -> None:
         """Close browser context"""
+        if self.watchdog is not None:
+            self.watchdog.stop()
         await self.browser_context.close()
         await self.playwright.stop()
         logger.info("[OpenAICrawler.close] Browser context closed ...")
 
     async def chat_completion(
-        self, model: str, messages=list[Message], stream: Optional[bool] = False
+        self,
+        model: str,
+        messages=list[Message],
+        stream: Optional[bool] = False,
+        on_finish: Optional[Callable] = None,
+        on_delta: Optional[Callable] = None,
     ):
         messages = [_.dict() for _ in messages]
 
+        self.outstanding_requests += 1
+        try:
+            # 页面都卡住时返回错误，而不是一直等待
+            openai_client = await self.page_pool.acquire(
+                model, timeout=config.MAX_QUEUE_WAIT
+            )
+        except Exception:
+            self.outstanding_requests -= 1
+            return self.error_response()
+        timing.mark("page_pool")
+
+        # 流式输出时，页面在输出结束后才归还
+        release_client = True
         try:
             if stream:
-                return StreamingResponse(
-                    await self.openai_client.create_completion(
-                        model, messages, stream=True
-                    ),
+                completion = await openai_client.create_completion(
+                    model,
+                    messages,
+                    stream=True,
+                    on_finish=on_finish,
+                    on_delta=on_delta,
+                )
+                release_client = False
+                return ClosingStreamingResponse(
+                    self.release_after(completion, openai_client),
                     media_type="text/event-stream",
                 )
             else:
-                return await self.openai_client.create_completion(model, messages)
+                return await openai_client.create_completion(
+                    model, messages, on_finish=on_finish, on_delta=on_delta
+                )
         except Exception:
-            return {
-                "status": False,
-                "error": {
-                    "message": "An error occurred. please try again. Additionally, ensure that your request complies with OpenAI's policy.",
-                    "type": "invalid_request_error",
-                },
-                "support": "https://github.com/adryfish/llm-web-api",
-            }
+            return self.error_response()
+        finally:
+            if release_client:
+                self.release(openai_client)
+
+    def release(self, openai_client: OpenAIClient):
+        self.outstanding_requests -= 1
+        self.page_pool.release(openai_client)
+
+    def release_after(
+        self, iterator: AsyncIterator, openai_client: OpenAIClient
+    ) -> AsyncIterator:
+        """Yield from a streaming completion and check the page in at the end"""
+        return ClosingIterator(iterator, lambda: self.release(openai_client))
+
+    def error_response(self):
+        return {
+            "status": False,
+            "error": {
+                "message": "An error occurred. please try again. Additionally, ensure that your request complies with OpenAI's policy.",
+                "type": "invalid_request_error",
+            },
+            "support": "https://github.com/adryfish/llm-web-api",
+        }
@@ -0,0 +1,93 @@
+from typing import AsyncIterator, Optional
+
+from llm import json_codec
+
+
+class DeltaTracker:
+    """Turn the cumulative answer of each upstream event into deltas.
+
+    The upstream sends the whole answer so far in every event, so the delta
+    is whatever lies past the part already emitted. Only the emitted length
+    is tracked and each delta costs a slice of its own size.
+    """
+
+    def __init__(self, prompts: list[str]):
+        # 上游会先回显用户的消息，先比较长度，长度相同时才计算哈希
+        self.prompt_contents = set(prompts)
+        self.prompt_lengths = {len(prompt) for prompt in prompts}
+
+        self.emitted = 0
+        self.content = ""
+
+    def is_echo(self, content: str) -> bool:
+        return len(content) in self.prompt_lengths and content in self.prompt_contents
+
+    def feed(self, content: str) -> str:
+        if len(content) <= self.emitted:
+            return ""
+        delta = content[self.emitted :]
+        self.emitted = len(content)
+        self.content = content
+        return delta
+
+
+class CompletionStream:
+    """Turn the upstream messages of one conversation into answer deltas.
+
+    Only non-empty deltas are yielded. Once the messages run out, `model`,
+    `finish_reason` and `error` describe how the answer ended, and
+    `conversation_id` and `message_id` locate the answer upstream.
+    """
+
+    def __init__(self, prompts: list[str], model: str):
+        self.tracker = DeltaTracker(prompts)
+        self.model = model
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[str] = None
+        self.conversation_id: Optional[str] = None
+        self.message_id: Optional[str] = None
+
+    @property
+    def content(self) -> str:
+        return self.tracker.content
+
+    async def deltas(self, messages: AsyncIterator[str]) -> AsyncIterator[str]:
+        async for message in messages:
+            # 跳过时间戳之类不是JSON对象的消息
+            if not message.startswith("{"):
+                continue
+
+            parsed = json_codec.loads(message)
+            if parsed.get("error"):
+                self.error = f"Error message from OpenAI: {parsed['error']}"
+                self.finish_reason = "stop"
+                return
+
+            content = parsed.get("message", {}).get("content", {}).get("parts", [""])[0]
+            status = parsed.get("message", {}).get("status", "")
+
+            if not content or self.tracker.is_echo(content):
+                continue
+
+            delta = self.tracker.feed(content)
+            self.conversation_id = parsed.get("conversation_id", self.conversation_id)
+            self.message_id = parsed.get("message", {}).get("id", self.message_id)
+            self.model = (
+                parsed.get("message", {})
+                .get("metadata", {})
+                .get("model_slug", self.model)
+            )
+            if delta:
+                yield delta
+
+            if status == "finished_successfully":
+                finish_details_type = (
+                    parsed.get("message", {})
+                    .get("metadata", {})
+                    .get("finish_details", {})
+                    .get("type")
+                )
+                self.finish_reason = (
+                    "length" if finish_details_type == "max_tokens" else "stop"
+                )
+                return
@@ -0,0 +1,79 @@
+import random
+import string
+from typing import Optional
+
+from llm import json_codec
+
+
+class ChunkEncoder:
+    """SSE frames of chat.completion.chunk objects for one completion.
+
+    id, created, object and model stay the same for every chunk of a
+    completion, so that part of the frame is serialized once and each frame
+    only encodes the delta content.
+    """
+
+    SUFFIXES = {
+        None: '},"index":0,"finish_reason":null}]}\n\n',
+        "stop": '},"index":0,"finish_reason":"stop"}]}\n\n',
+        "length": '},"index":0,"finish_reason":"length"}]}\n\n',
+    }
+
+    def __init__(self, request_id: str, created: int, model: str):
+        self.request_id = request_id
+        self.created = created
+        self.set_model(model)
+
+    def set_model(self, model: str):
+        self.model = model
+        self._prefix = (
+            f'data: {{"id":{json_codec.dumps(self.request_id)},'
+            f'"created":{self.created},'
+            f'"object":"chat.completion.chunk",'
+            f'"model":{json_codec.dumps(model)},'
+            f'"choices":[{{"delta":{{"content":'
+        )
+
+    def encode(
+        self,
+        content: str,
+        finish_reason: Optional[str] = None,
+        model: Optional[str] = None,
+    ) -> str:
+        if model is not None and model != self.model:
+            self.set_model(model)
+        suffix = self.SUFFIXES.get(finish_reason)
+        if suffix is None:
+            suffix = (
+                f'}},"index":0,"finish_reason":{json_codec.dumps(finish_reason)}}}]}}\n\n'
+            )
+        return self._prefix + json_codec.dumps(content) + suffix
+
+
+def generate_completion_id(prefix: str = "cmpl-") -> str:
+    characters = string.ascii_lowercase + string.ascii_uppercase + string.digits
+    return prefix + "".join(random.choice(characters) for _ in range(28))
+
+
+def completion_response(
+    request_id: str,
+    created: int,
+    model: str,
+    content: str,
+    finish_reason: Optional[str],
+) -> dict:
+    """The chat.completion object of a non-streaming response"""
+    return {
+        "id": request_id,
+        "model": model,
+        "object": "chat.completion",
+        "choices": [
+            {
+                "message": {"role": "assistant", "content": content},
+                "index": 0,
+                "finish_reason": finish_reason,
+            }
+        ],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        "created": created,
+    }
@@ -3,8 +3,9 @@ from typing import Optional
 
 from playwright.async_api import Page
 
+from llm import metrics
 from llm.logger import logger
-from llm.provider.openai.cloudflare_bypass import CloudflareBypass
+from llm.provider.openai.cloudflare_bypass import bypass_in_thread
 
 
 class OpenAILogin:
@@ -46,15 +47,21 @@ class OpenAILogin:
             logger.info("[OpenAILogin.bypass_cloudflare] Meet cloudflare challenge")
             # bypass cloudflare
             user_agent = await self.context_page.evaluate("navigator.userAgent")
-            cloudflare_bypass = CloudflareBypass(
-                proxy_server=self.proxies, user_agent=user_agent
-            )
-            cookies = cloudflare_bypass.bypass(self.context_page.url)
+            try:
+                # 在单独的线程中完成，不阻塞其他页面的请求
+                cookies = await bypass_in_thread(
+                    self.context_page.url,
+                    proxy_server=self.proxies,
+                    user_agent=user_agent,
+                )
+            except Exception:
+                metrics.CLOUDFLARE_BYPASS.inc(result="failed")
+                raise
+            metrics.CLOUDFLARE_BYPASS.inc(result="passed")
 
             await self.context_page.context.clear_cookies()
             await self.context_page.context.add_cookies(cookies)
 
-            cloudflare_bypass.close()
             logger.info("[OpenAILogin.bypass_cloudflare] Finish cloudflare challenge")
 
             await self.context_page.reload()
@@ -0,0 +1,158 @@
+import asyncio
+from collections import deque
+from typing import Optional
+
+from llm.logger import logger
+from llm.provider.openai.client import OpenAIClient
+
+# 每来一个请求，之前的需求衰减到原来的这个比例
+DEMAND_DECAY = 0.95
+
+
+class PagePool:
+    """A pool of browser pages, each driven by its own OpenAIClient.
+
+    A request checks out an idle client, runs one completion on its page and
+    checks it back in once the answer is fully delivered.
+
+    Pages stay on the model they last served, and a request prefers an idle
+    page already on its model, so the model menu is rarely clicked inline.
+    Demand is tracked as each model's decaying share of recent requests; a
+    page going idle on a model with more pages than its share is switched to
+    the model short of pages most, in the background.
+    """
+
+    def __init__(self):
+        self.clients: list[OpenAIClient] = []
+        self._idle: list[OpenAIClient] = []
+        self._waiters: deque[asyncio.Future] = deque()
+        self.demand: dict[str, float] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # 正在移出的页面，请求结束后不再放回
+        self._draining: dict[OpenAIClient, asyncio.Future] = {}
+
+    @property
+    def size(self) -> int:
+        return len(self.clients)
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    @property
+    def busy_count(self) -> int:
+        return self.size - self.idle_count
+
+    def add(self, client: OpenAIClient):
+        self.clients.append(client)
+        self._put(client)
+        logger.info(f"[PagePool.add] Page added, pool size is {self.size}")
+
+    async def acquire(
+        self, model: Optional[str] = None, timeout: Optional[float] = None
+    ) -> OpenAIClient:
+        if model:
+            self._record_demand(model)
+        if self._idle and not self._waiters:
+            client = self._pick(model)
+            self._rebalance()
+            return client
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 放弃等待时刚好分到了页面，还回去
+                self.release(future.result())
+            elif future in self._waiters:
+                self._waiters.remove(future)
+            if isinstance(e, asyncio.TimeoutError):
+                logger.error(
+                    f"[PagePool.acquire] No idle page, {self.busy_count}/{self.size} busy"
+                )
+                raise Exception("Too many requests. please slow down.")
+            raise
+
+    def release(self, client: OpenAIClient):
+        self._put(client)
+
+    async def drain(self, client: OpenAIClient):
+        """Take a page out of the pool, after its current request if it is busy"""
+        self.clients.remove(client)
+        if client in self._idle:
+            self._idle.remove(client)
+            return
+        future = self._draining[client] = asyncio.get_running_loop().create_future()
+        await future
+
+    def _put(self, client: OpenAIClient, rebalance: bool = True):
+        future = self._draining.pop(client, None)
+        if future is not None:
+            if not future.done():
+                future.set_result(None)
+            return
+        # 按先后顺序交给等待的请求，已经放弃的跳过
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(client)
+                return
+        self._idle.append(client)
+        if rebalance:
+            self._rebalance()
+
+    def _record_demand(self, model: str):
+        for name in self.demand:
+            self.demand[name] *= DEMAND_DECAY
+        self.demand[model] = self.demand.get(model, 0) + 1 - DEMAND_DECAY
+
+    def _surplus(self, model: Optional[str]) -> float:
+        """Pages on the model minus the pages its demand share asks for"""
+        pages = sum(1 for client in self.clients if client.page_model == model)
+        return pages - self.demand.get(model, 0) * self.size
+
+    def _pick(self, model: Optional[str]) -> OpenAIClient:
+        # 优先使用已经在这个模型上的页面，否则使用所在模型最富余的页面
+        client = next(
+            (client for client in self._idle if not client.needs_model_switch(model)),
+            None,
+        )
+        if client is None:
+            client = max(
+                self._idle, key=lambda client: self._surplus(client.page_model)
+            )
+        self._idle.remove(client)
+        return client
+
+    def _rebalance(self):
+        # 同一时间只在后台切换一个页面
+        if self._tasks or not self.demand:
+            return
+        candidates = [client for client in self._idle if client.can_switch_model]
+        if not candidates:
+            return
+        client = max(candidates, key=lambda client: self._surplus(client.page_model))
+        target = min(self.demand, key=self._surplus)
+        # 移动一个页面会让两边的差距减少2，差距大于1时才能更均衡
+        if self._surplus(client.page_model) - self._surplus(target) <= 1:
+            return
+
+        self._idle.remove(client)
+        task = asyncio.create_task(self._switch(client, target))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _switch(self, client: OpenAIClient, model: str):
+        logger.info(
+            f"[PagePool._switch] Switching an idle page from {client.page_model} to {model}"
+        )
+        try:
+            await client.prepare_model(model)
+        except Exception as e:
+            logger.error(f"[PagePool._switch] Fail to switch model: {str(e)}")
+        finally:
+            self._tasks.discard(asyncio.current_task())
+            # 切换失败时不再马上重试，成功时继续检查其他页面
+            self._put(client, rebalance=client.page_model == model)
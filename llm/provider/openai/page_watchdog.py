@@ -0,0 +1,115 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from llm import metrics
+from llm.logger import logger
+from llm.provider.openai.client import OpenAIClient
+from llm.provider.openai.page_pool import PagePool
+
+
+class PageWatchdog:
+    """Replaces pages that grew too big or served too many conversations.
+
+    Every `interval` seconds each page's JS heap and DOM node count are read
+    through CDP `Performance.getMetrics`. A page over a limit gets a new page
+    added to the pool first, then is drained in the background: an idle page
+    is closed right away, a busy one after its request is delivered, while
+    the other pages keep being checked.
+    """
+
+    def __init__(
+        self,
+        page_pool: PagePool,
+        new_client: Callable[[], Awaitable[OpenAIClient]],
+        interval: float,
+        max_js_heap: float,
+        max_dom_nodes: int,
+        max_conversations: int,
+    ):
+        self.page_pool = page_pool
+        self.new_client = new_client
+        self.interval = interval
+        self.max_js_heap = max_js_heap
+        self.max_dom_nodes = max_dom_nodes
+        self.max_conversations = max_conversations
+        self.task: Optional[asyncio.Task] = None
+        self._retiring: set[asyncio.Task] = set()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        for task in self._retiring:
+            task.cancel()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"[PageWatchdog.run] Fail to check pages: {str(e)}")
+
+    async def check(self):
+        for client in list(self.page_pool.clients):
+            reason = await self.over_limit(client)
+            if reason:
+                await self.replace(client, reason)
+
+    @staticmethod
+    async def sample(client: OpenAIClient) -> dict[str, float]:
+        page = client.playwright_page
+        session = await page.context.new_cdp_session(page)
+        try:
+            await session.send("Performance.enable")
+            result = await session.send("Performance.getMetrics")
+        finally:
+            await session.detach()
+        return {metric["name"]: metric["value"] for metric in result["metrics"]}
+
+    async def over_limit(self, client: OpenAIClient) -> Optional[str]:
+        """The limit the page crossed, None if it is within all of them"""
+        if self.max_conversations and client.conversations >= self.max_conversations:
+            return "conversations"
+
+        try:
+            sample = await self.sample(client)
+        except Exception as e:
+            logger.error(f"[PageWatchdog.over_limit] Fail to read metrics: {str(e)}")
+            return None
+        js_heap = sample.get("JSHeapUsedSize", 0) / 1024 / 1024
+        nodes = sample.get("Nodes", 0)
+        logger.debug(
+            f"[PageWatchdog.over_limit] js_heap={js_heap:.1f}MB nodes={int(nodes)} conversations={client.conversations}"
+        )
+        if js_heap >= self.max_js_heap:
+            return "js_heap"
+        if nodes >= self.max_dom_nodes:
+            return "dom_nodes"
+        return None
+
+    async def replace(self, client: OpenAIClient, reason: str):
+        logger.info(
+            f"[PageWatchdog.replace] Replacing a page after {client.conversations} conversations, over {reason} limit"
+        )
+        # 先补充新页面再移出旧页面，替换过程中可用页面数不减少
+        try:
+            replacement = await self.new_client()
+        except Exception as e:
+            logger.error(f"[PageWatchdog.replace] Fail to open a new page: {str(e)}")
+            return
+        self.page_pool.add(replacement)
+        # 忙碌的页面要等请求结束，不能让检查其他页面也一起等待
+        task = asyncio.create_task(self.retire(client, reason))
+        self._retiring.add(task)
+        task.add_done_callback(self._retiring.discard)
+
+    async def retire(self, client: OpenAIClient, reason: str):
+        await self.page_pool.drain(client)
+        try:
+            await client.close()
+        except Exception as e:
+            logger.error(f"[PageWatchdog.replace] Fail to close the page: {str(e)}")
+        metrics.PAGE_RECYCLES.inc(reason=reason)
@@ -0,0 +1,78 @@
+import copy
+import time
+import uuid
+from typing import Optional
+
+from llm.logger import logger
+from llm.provider.openai.thread_index import Thread
+
+
+class RequestTemplate:
+    """Headers and body of a real conversation request sent by the page.
+
+    Once captured, later completions can be posted straight to the upstream
+    without typing into the page. The template is dropped when it gets older
+    than `ttl` seconds or when the upstream rejects it, and the next request
+    sent by the page captures a fresh one.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self.path: Optional[str] = None
+        self.headers: Optional[dict] = None
+        self.body: Optional[dict] = None
+        self.captured_at = 0.0
+
+    def is_valid(self) -> bool:
+        return (
+            self.body is not None and time.monotonic() - self.captured_at < self.ttl
+        )
+
+    def capture(self, path: str, headers: dict, body: dict):
+        self.path = path
+        self.headers = {
+            key: value
+            for key, value in headers.items()
+            if key.lower() not in ("content-length", "host")
+        }
+        self.body = copy.deepcopy(body)
+        self.captured_at = time.monotonic()
+        logger.info(f"[RequestTemplate.capture] Captured template for {path}")
+
+    def invalidate(self):
+        if self.body is not None:
+            logger.info("[RequestTemplate.invalidate] Template is dropped")
+        self.body = None
+
+    def render(
+        self,
+        messages: list[dict[str, any]],
+        model_slug: Optional[str] = None,
+        thread: Optional[Thread] = None,
+    ) -> dict:
+        """Build the body of a new conversation carrying the given messages,
+        or of a continuation of `thread` when given"""
+        body = copy.deepcopy(self.body)
+        body["messages"] = [
+            {
+                "id": str(uuid.uuid4()),
+                "author": {"role": message["role"]},
+                "content": {
+                    "content_type": "text",
+                    "parts": [message["content"]],
+                },
+                "metadata": {},
+            }
+            for message in messages
+        ]
+        if thread is not None:
+            body["conversation_id"] = thread.conversation_id
+            body["parent_message_id"] = thread.message_id
+        else:
+            body["parent_message_id"] = str(uuid.uuid4())
+            body.pop("conversation_id", None)
+        if "websocket_request_id" in body:
+            body["websocket_request_id"] = str(uuid.uuid4())
+        if model_slug:
+            body["model"] = model_slug
+        return body
@@ -0,0 +1,106 @@
+from collections import Counter
+from typing import Optional
+from urllib.parse import urlparse
+
+from playwright.async_api import BrowserContext, Page, Request, Route
+
+from llm import config, metrics
+from llm.logger import logger
+
+# email登录时经过的登录页面和它加载资源的域名
+EMAIL_LOGIN_HOSTS = [
+    "auth.openai.com",
+    "auth0.openai.com",
+    "cdn.auth0.com",
+    "cdn.openai.com",
+    "openaiapi-site.azureedge.net",
+]
+
+
+class ResourceBlocker:
+    """Aborts the requests a chat page does not need, for a whole browser context.
+
+    A request goes through when both its resource type and its host (or a
+    parent domain of it) are allowed. Routes set on a page, such as the
+    conversation interception, run before this one and are not affected.
+
+    Blocked requests are counted per page load and logged when the page
+    fires `load`. Their size cannot be reported: an aborted request never
+    gets a response, so the bytes saved are unknown.
+    """
+
+    def __init__(self, resource_types: list[str], hosts: list[str]):
+        self.resource_types = set(resource_types)
+        self.hosts = [host for host in hosts if host]
+        self.blocked: dict[Page, Counter] = {}
+
+    @staticmethod
+    def host_of(url: Optional[str]) -> Optional[str]:
+        return urlparse(url).hostname if url else None
+
+    async def install(self, browser_context: BrowserContext):
+        await browser_context.route("**/*", self.handle)
+
+    def allowed(self, request: Request) -> bool:
+        if request.resource_type not in self.resource_types:
+            return False
+        host = self.host_of(request.url) or ""
+        return any(
+            host == allowed or host.endswith(f".{allowed}") for allowed in self.hosts
+        )
+
+    async def handle(self, route: Route):
+        request = route.request
+        page = self.page_of(request)
+        if page is not None and request.is_navigation_request():
+            if request.frame.parent_frame is None:
+                # 新的页面加载，重新计数
+                self.track(page).clear()
+
+        if self.allowed(request):
+            await route.fallback()
+            return
+
+        metrics.BLOCKED_REQUESTS.inc(resource_type=request.resource_type)
+        if page is not None:
+            self.track(page)[request.resource_type] += 1
+        await route.abort("blockedbyclient")
+
+    def page_of(self, request: Request) -> Optional[Page]:
+        # service worker发出的请求没有frame
+        try:
+            return request.frame.page
+        except Exception:
+            return None
+
+    def track(self, page: Page) -> Counter:
+        if page not in self.blocked:
+            self.blocked[page] = Counter()
+            page.on("load", self.report)
+            page.on("close", self.forget)
+        return self.blocked[page]
+
+    def forget(self, page: Page):
+        self.blocked.pop(page, None)
+
+    def report(self, page: Page):
+        blocked = self.blocked.get(page)
+        if not blocked:
+            return
+        details = " ".join(f"{name}={count}" for name, count in blocked.most_common())
+        logger.info(
+            f"[ResourceBlocker.report] Blocked {sum(blocked.values())} requests while loading {page.url}: {details}"
+        )
+
+
+def allowed_hosts(login_type: str) -> list[str]:
+    """ALLOWED_HOSTS plus the hosts a page must reach to chat and to log in"""
+    hosts = [
+        ResourceBlocker.host_of(config.OPENAI_HOST),
+        ResourceBlocker.host_of(config.OPENAI_FIRST_SITE_URL),
+        *config.ALLOWED_HOSTS,
+    ]
+    # 拦截登录页面的跳转会导致email登录失败
+    if login_type == "email":
+        hosts.extend(EMAIL_LOGIN_HOSTS)
+    return hosts
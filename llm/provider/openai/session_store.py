@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+import time
+from typing import Optional
+
+from llm.logger import logger
+
+# 这些cookie过期后，会话就不能再用了
+SESSION_COOKIES = ("__Secure-next-auth.session-token", "cf_clearance")
+
+
+class SessionStore:
+    """Playwright storage_state of one account, kept on disk between restarts.
+
+    Besides the state itself the file records when it was saved and when its
+    session cookies expire, so an expired session is not restored at all.
+    Writes go to a temporary file first and replace the old one atomically.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.saved_at: Optional[float] = None
+        self.expires_at: Optional[float] = None
+
+    @staticmethod
+    def session_expiry(storage_state: dict) -> Optional[float]:
+        expires = [
+            cookie["expires"]
+            for cookie in storage_state.get("cookies", [])
+            if cookie.get("name") in SESSION_COOKIES and cookie.get("expires", -1) > 0
+        ]
+        return min(expires) if expires else None
+
+    def save(self, storage_state: dict):
+        self.saved_at = time.time()
+        self.expires_at = self.session_expiry(storage_state)
+        data = {
+            "saved_at": self.saved_at,
+            "expires_at": self.expires_at,
+            "storage_state": storage_state,
+        }
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        # 同一个帐号的多个页面可能同时保存，每次使用不同的临时文件
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def load(self) -> Optional[dict]:
+        """The saved storage_state without expired cookies, None if it expired"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"[SessionStore.load] Fail to read {self.path}: {str(e)}")
+            return None
+
+        now = time.time()
+        self.saved_at = data.get("saved_at")
+        self.expires_at = data.get("expires_at")
+        if self.expires_at and self.expires_at <= now:
+            logger.info("[SessionStore.load] Saved session has expired")
+            return None
+
+        storage_state = data.get("storage_state") or {}
+        storage_state["cookies"] = [
+            cookie
+            for cookie in storage_state.get("cookies", [])
+            if cookie.get("expires", -1) <= 0 or cookie["expires"] > now
+        ]
+        return storage_state
@@ -0,0 +1,116 @@
+from typing import Optional, Union
+
+
+class SSEEvent:
+    __slots__ = ("event", "data", "id")
+
+    def __init__(self, event: str, data: str, id: Optional[str] = None):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, data={self.data!r}, id={self.id!r})"
+
+
+class SSEDecoder:
+    """Incremental decoder for a text/event-stream body.
+
+    Bytes are fed as they arrive and every complete event is returned once.
+    Each byte is scanned a single time, so the work is linear in the size of
+    the stream no matter how it is split into chunks. Comment lines (used as
+    heartbeats) are skipped and `data: [DONE]` ends the stream.
+    """
+
+    DONE = "[DONE]"
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 缓冲区中这个位置之前没有换行符，下次从这里继续查找
+        self._scan_from = 0
+
+        self._event: Optional[str] = None
+        self._data: list[str] = []
+        self._id: Optional[str] = None
+
+        self.done = False
+        self.heartbeats = 0
+
+    def feed(self, chunk: Union[bytes, str]) -> list[SSEEvent]:
+        if self.done:
+            return []
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+
+        buffer = self._buffer
+        buffer.extend(chunk)
+
+        events = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", max(start, self._scan_from))
+            if end < 0:
+                break
+            line_end = end - 1 if end > start and buffer[end - 1] == 0x0D else end
+            if line_end == start:
+                event = self._dispatch()
+            elif buffer.startswith(b"data: ", start, line_end):
+                # 绝大多数行是data行，直接解码数据部分，少复制一次
+                self._data.append(
+                    buffer[start + 6 : line_end].decode("utf-8", errors="replace")
+                )
+                event = None
+            else:
+                line = buffer[start:line_end].decode("utf-8", errors="replace")
+                event = self._process_line(line)
+            start = end + 1
+
+            if event is None:
+                continue
+            if event.data == self.DONE:
+                self.done = True
+                break
+            events.append(event)
+
+        del buffer[:start]
+        self._scan_from = len(buffer)
+        return events
+
+    def close(self) -> list[SSEEvent]:
+        """Flush an event left without its trailing blank line"""
+        if self.done:
+            return []
+        events = self.feed(b"\n\n") if self._buffer else []
+        event = self._dispatch()
+        if event is not None and event.data != self.DONE:
+            events.append(event)
+        self.done = True
+        return events
+
+    def _process_line(self, line: str) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line[0] == ":":
+            self.heartbeats += 1
+            return None
+
+        field, sep, value = line.partition(":")
+        if sep and value[:1] == " ":
+            value = value[1:]
+
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            self._id = value
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._data:
+            self._event = None
+            return None
+        event = SSEEvent(self._event or "message", "\n".join(self._data), self._id)
+        self._event = None
+        self._data = []
+        return event
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class Thread:
+    """An upstream conversation and the answer to continue it from"""
+
+    def __init__(self, conversation_id: str, message_id: str):
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.created_at = time.monotonic()
+
+
+class ThreadIndex:
+    """Upstream conversations keyed on the message history that produced them.
+
+    After an answer, the history plus that answer maps to the conversation
+    and the answer's message id. A later request whose history starts with
+    a known prefix continues that conversation and only sends the messages
+    past the prefix. An LRU of at most `max_entries`, entries expire after
+    `ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._threads: OrderedDict[str, Thread] = OrderedDict()
+
+    @staticmethod
+    def prefix_keys(messages: list[dict]) -> list[str]:
+        """Key of every prefix, keys[i] covers messages[: i + 1]"""
+        # 逐条更新哈希，所有前缀的key一共只需要遍历一次消息
+        digest = hashlib.sha256()
+        keys = []
+        for message in messages:
+            item = [message["role"].strip().lower(), message["content"].strip()]
+            digest.update(json.dumps(item, ensure_ascii=False).encode())
+            digest.update(b"\n")
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    def get(self, key: str) -> Optional[Thread]:
+        thread = self._threads.get(key)
+        if thread is None:
+            return None
+        if time.monotonic() - thread.created_at > self.ttl:
+            del self._threads[key]
+            return None
+        self._threads.move_to_end(key)
+        return thread
+
+    def find(self, messages: list[dict]) -> Optional[tuple[Thread, list[dict]]]:
+        """The thread of the longest known prefix and the messages after it"""
+        keys = self.prefix_keys(messages)
+        # 前缀以assistant的回答结尾，并且后面至少还有一条新消息
+        for end in range(len(messages) - 1, 0, -1):
+            if messages[end - 1]["role"] != "assistant":
+                continue
+            thread = self.get(keys[end - 1])
+            if thread is not None:
+                return thread, messages[end:]
+        return None
+
+    def put(self, messages: list[dict], answer: str, thread: Thread):
+        history = [*messages, {"role": "assistant", "content": answer}]
+        key = self.prefix_keys(history)[-1]
+        self._threads[key] = thread
+        self._threads.move_to_end(key)
+        while len(self._threads) > self.max_entries:
+            self._threads.popitem(last=False)
+
+    def discard(self, thread: Thread):
+        """Forget a conversation the upstream no longer accepts"""
+        for key in [key for key, value in self._threads.items() if value is thread]:
+            del self._threads[key]
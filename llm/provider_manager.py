@@ -1,7 +1,10 @@
-from typing import Optional
+import asyncio
+import time
+from typing import Callable, Optional
 
 from llm import config
 from llm.base.crawler import AbstractCrawler
+from llm.logger import logger
 from llm.provider.openai.core import OpenAICrawler
 
 
@@ -9,34 +12,121 @@ class CrawlerFactory:
     CRAWLERS = {
         "openai": OpenAICrawler,
     }
+    ACCOUNTS = {
+        "openai": config.OPENAI_ACCOUNTS,
+    }
 
     @staticmethod
-    def create_crawler(provider: str) -> AbstractCrawler:
+    def create_crawlers(provider: str) -> list[AbstractCrawler]:
+        """Create one crawler per configured account of the provider"""
         crawler_class = CrawlerFactory.CRAWLERS.get(provider)
         if not crawler_class:
             raise ValueError("Invalid provider. Currently only supported openai")
-        return crawler_class()
+        return [
+            crawler_class(account_index=index, email=email, password=password)
+            for index, (email, password) in enumerate(
+                CrawlerFactory.ACCOUNTS.get(provider)
+            )
+        ]
 
 
 class ProviderManager:
     def __init__(self, enabled_providers: list[str]):
-        self.provider_dict: dict[str, AbstractCrawler] = {}
+        self.provider_dict: dict[str, list[AbstractCrawler]] = {}
 
         for provider in enabled_providers:
-            crawler = CrawlerFactory.create_crawler(provider)
-            self.provider_dict[provider] = crawler
+            self.provider_dict[provider] = CrawlerFactory.create_crawlers(provider)
+
+    async def start_all(
+        self, on_capacity_change: Optional[Callable[[int], None]] = None
+    ):
+        """Start every account at the same time, one failing does not stop the others"""
+        ts = time.perf_counter()
+        crawlers = [
+            crawler for crawlers in self.provider_dict.values() for crawler in crawlers
+        ]
+        if on_capacity_change:
+            for crawler in crawlers:
+                crawler.on_page_ready = lambda: on_capacity_change(self.capacity)
+
+        results = await asyncio.gather(
+            *(crawler.start() for crawler in crawlers), return_exceptions=True
+        )
+        for crawler, result in zip(crawlers, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    f"[ProviderManager.start_all] Fail to start {type(crawler).__name__}: {str(result)}"
+                )
+        logger.info(
+            f"[ProviderManager.start_all] Started in {time.perf_counter() - ts:.1f}s, capacity {self.capacity}"
+        )
 
-    async def start_all(self):
-        for crawler in self.provider_dict.values():
-            await crawler.start()
+    def startup_status(self) -> dict:
+        return {
+            provider: [crawler.startup_status() for crawler in crawlers]
+            for provider, crawlers in self.provider_dict.items()
+        }
+
+    @property
+    def capacity(self) -> int:
+        return sum(
+            crawler.capacity
+            for crawlers in self.provider_dict.values()
+            for crawler in crawlers
+        )
+
+    @property
+    def models(self) -> list[str]:
+        """Models served by the accounts that have a page ready"""
+        return sorted(
+            {
+                model
+                for crawlers in self.provider_dict.values()
+                for crawler in crawlers
+                if crawler.capacity > 0
+                for model in crawler.supported_model
+            }
+        )
 
     def get_provider(self, model: str) -> Optional[AbstractCrawler]:
-        for provider in self.provider_dict.values():
-            if model in provider.supported_model:
-                return provider
-        return None
+        """Pick the account with an idle page, then the least loaded one for the model"""
+        candidates = [
+            crawler
+            for crawlers in self.provider_dict.values()
+            for crawler in crawlers
+            if model in crawler.supported_model
+        ]
+        if not candidates:
+            return None
+        # 优先选择有可用页面的帐号，其中优先选择有空闲页面的；都没有页面时
+        # 选择还在启动的帐号，启动失败的帐号不再使用
+        ready = [crawler for crawler in candidates if crawler.capacity > 0]
+        idle = [crawler for crawler in ready if crawler.idle_capacity > 0]
+        starting = [crawler for crawler in candidates if crawler.starting]
+        # 各帐号的页面数可能不同，按每个页面分到的请求数比较
+        return min(
+            idle or ready or starting or candidates,
+            key=lambda crawler: crawler.outstanding_requests / max(crawler.capacity, 1),
+        )
+
+    def unavailable(self, model: str) -> Optional[str]:
+        """Why no account can serve the model, None while one has or may get pages"""
+        candidates = [
+            crawler
+            for crawlers in self.provider_dict.values()
+            for crawler in crawlers
+            if model in crawler.supported_model
+        ]
+        if any(crawler.capacity > 0 or crawler.starting for crawler in candidates):
+            return None
+        errors = sorted(
+            {crawler.startup_error for crawler in candidates if crawler.startup_error}
+        )
+        return f"No account is available for model {model}" + (
+            f": {'; '.join(errors)}" if errors else ""
+        )
 
-    def get_all_providers(self) -> dict[str, AbstractCrawler]:
+    def get_all_providers(self) -> dict[str, list[AbstractCrawler]]:
         return self.provider_dict
 
 
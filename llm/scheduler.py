@@ -0,0 +1,157 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import AsyncIterator
+
+from llm import config, metrics
+from llm.logger import logger
+from llm.streaming import ClosingIterator
+
+
+class QueueFullError(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Admission:
+    def __init__(self, wait_time: float):
+        self.wait_time = wait_time
+        self.admitted_at = time.monotonic()
+
+
+class AdmissionScheduler:
+    """Bounded FIFO queue in front of the providers.
+
+    At most `capacity` requests run at the same time, the rest wait in strict
+    arrival order. A request is rejected when the queue is full or when it
+    waited longer than `max_wait` seconds.
+    """
+
+    def __init__(
+        self, capacity: int = 0, max_queue_size: int = 64, max_wait: float = 60
+    ):
+        self.capacity = capacity
+        self.max_queue_size = max_queue_size
+        self.max_wait = max_wait
+
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+        # 平均服务时间，用于计算Retry-After
+        self.avg_service_time = None
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.wait_time_total = 0.0
+        self.last_wait_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def set_capacity(self, capacity: int):
+        self.capacity = capacity
+        self._wake_up()
+
+    def retry_after(self) -> int:
+        service_time = self.avg_service_time or 1
+        slots = max(self.capacity, 1)
+        return max(1, math.ceil((self.queue_depth + 1) * service_time / slots))
+
+    async def acquire(self) -> Admission:
+        if self.active < self.capacity and not self._waiters:
+            self.active += 1
+            return self._admit(0)
+
+        if self.queue_depth >= self.max_queue_size:
+            self.rejected_total += 1
+            raise QueueFullError(
+                "Too many requests. please slow down.", self.retry_after()
+            )
+
+        ts = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._remove(waiter)
+                self.rejected_total += 1
+                raise QueueFullError(
+                    "Request waited too long in the queue. please slow down.",
+                    self.retry_after(),
+                )
+        except asyncio.CancelledError:
+            # 客户端断开连接，如果已经分配了位置要还回去
+            if waiter.done():
+                self.active -= 1
+                self._wake_up()
+            else:
+                self._remove(waiter)
+            raise
+        return self._admit(time.monotonic() - ts)
+
+    def release(self, admission: Admission):
+        service_time = time.monotonic() - admission.admitted_at
+        if self.avg_service_time is None:
+            self.avg_service_time = service_time
+        else:
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+
+        self.active -= 1
+        self._wake_up()
+
+    def release_after(
+        self, iterator: AsyncIterator, admission: Admission
+    ) -> AsyncIterator:
+        """Yield from a streaming response and free the slot at the end"""
+        return ClosingIterator(iterator, lambda: self.release(admission))
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "max_queue_size": self.max_queue_size,
+            "max_wait": self.max_wait,
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "avg_wait_time": (
+                self.wait_time_total / self.admitted_total if self.admitted_total else 0
+            ),
+            "last_wait_time": self.last_wait_time,
+            "avg_service_time": self.avg_service_time or 0,
+        }
+
+    def _admit(self, wait_time: float) -> Admission:
+        self.admitted_total += 1
+        self.wait_time_total += wait_time
+        self.last_wait_time = wait_time
+        metrics.QUEUE_WAIT.observe(wait_time)
+        if wait_time > 1:
+            logger.info(
+                f"[AdmissionScheduler.acquire] Waited {wait_time:.3f}s in the queue"
+            )
+        return Admission(wait_time)
+
+    def _remove(self, waiter: asyncio.Future):
+        waiter.cancel()
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _wake_up(self):
+        while self._waiters and self.active < self.capacity:
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+
+scheduler = AdmissionScheduler(
+    max_queue_size=config.MAX_QUEUE_SIZE, max_wait=config.MAX_QUEUE_WAIT
+)
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from typing import AsyncIterator, Optional, Union
+
+from fastapi.responses import StreamingResponse
+
+from llm import metrics
+from llm.provider.openai.encoder import (
+    ChunkEncoder,
+    completion_response,
+    generate_completion_id,
+)
+from llm.streaming import ClosingIterator
+
+
+class Flight:
+    """One upstream generation shared by identical concurrent requests.
+
+    The leader's request records every delta, followers read them from the
+    start at their own pace.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.deltas: list[str] = []
+        self.finish_reason: Optional[str] = None
+        self.finished = False
+        self.closed = False
+        self.followers = 0
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def add_delta(self, delta: str, model: str):
+        self.deltas.append(delta)
+        self.model = model
+        self._notify()
+
+    def finish(self, model: str, finish_reason: str):
+        self.model = model
+        self.finish_reason = finish_reason
+        self.finished = True
+        self._notify()
+
+    def close(self):
+        """The leader's request ended, finished or not"""
+        self.closed = True
+        self._notify()
+
+    async def wait(self, condition):
+        while not condition() and not self.closed:
+            await self._changed.wait()
+
+    async def iter_deltas(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.deltas):
+                yield self.deltas[index]
+                index += 1
+            if self.finished or self.closed:
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """Identical requests in flight at the same time share one generation.
+
+    The first request for a key leads and goes upstream, the ones arriving
+    before it ends follow it. A follower falls back to its own request when
+    the leader fails before the follower has sent anything.
+    """
+
+    def __init__(self):
+        self.flights: dict[str, Flight] = {}
+
+    def join(self, key: str) -> Optional[Flight]:
+        flight = self.flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+        return flight
+
+    def lead(self, key: str, model: str) -> Flight:
+        flight = self.flights[key] = Flight(model)
+        return flight
+
+    def land(self, key: str, flight: Flight):
+        flight.close()
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    async def respond(
+        self, flight: Flight, stream: bool
+    ) -> Optional[Union[dict, StreamingResponse]]:
+        """The follower's own completion, None if the leader failed"""
+        request_id = generate_completion_id("chatcmpl-")
+        created = int(time.time())
+
+        if not stream:
+            await flight.wait(lambda: flight.finished)
+            if not flight.finished:
+                return None
+            metrics.COALESCED.inc()
+            return completion_response(
+                request_id,
+                created,
+                flight.model,
+                "".join(flight.deltas),
+                flight.finish_reason,
+            )
+
+        await flight.wait(lambda: flight.deltas or flight.finished)
+        if not flight.deltas and not flight.finished:
+            return None
+        metrics.COALESCED.inc()
+        encoder = ChunkEncoder(request_id, created, flight.model)
+
+        async def frames():
+            async for delta in flight.iter_deltas():
+                yield encoder.encode(delta, model=flight.model)
+            # 领头的请求中途失败时，不发送结束标记，客户端会看到不完整的流
+            if flight.finished:
+                yield encoder.encode("", flight.finish_reason, model=flight.model)
+                yield "data: [DONE]\n\n"
+
+        return StreamingResponse(frames(), media_type="text/event-stream")
+
+    def land_after(
+        self, iterator: AsyncIterator, key: str, flight: Flight
+    ) -> AsyncIterator:
+        """Yield from a streaming response and end the flight at the end"""
+        return ClosingIterator(iterator, lambda: self.land(key, flight))
+
+
+single_flight = SingleFlight()
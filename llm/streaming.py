@@ -0,0 +1,54 @@
+from typing import AsyncIterator, Callable
+
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+
+class ClosingIterator:
+    """Yield from `iterator` and call `on_close` once it ends, fails or is closed.
+
+    Unlike a try/finally in an async generator, `on_close` also runs when the
+    iterator is closed before its first item was asked for.
+    """
+
+    def __init__(self, iterator: AsyncIterator, on_close: Callable[[], None]):
+        self.iterator = iterator
+        self.on_close = on_close
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.iterator.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            aclose = getattr(self.iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            self.on_close()
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """A StreamingResponse that always closes its body iterator.
+
+    Starlette neither closes the body nor runs background tasks when the
+    client is gone before or while the body is sent.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
@@ -0,0 +1,284 @@
+import asyncio
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from llm import config
+from llm.dispatcher import forward
+from llm.logger import logger
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "llm", "main.py")
+
+# 检查worker状态的间隔(秒)
+POLL_INTERVAL = 2
+# worker运行超过这个时间(秒)后退出，重启等待时间从头计算
+STABLE_AFTER = 60
+# 停止worker时等待其退出的时间(秒)，超时后强制结束
+STOP_TIMEOUT = 10
+
+
+class WorkerProcess:
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process: Optional[asyncio.subprocess.Process] = None
+        # 进程在运行并且能响应请求
+        self.alive = False
+        # 至少有一个页面可用
+        self.ready = False
+        # 最近一次状态检查报告的页面数和模型
+        self.capacity = 0
+        self.models: list[str] = []
+        self.outstanding = 0
+        self.restarts = 0
+
+    def status(self) -> dict:
+        return {
+            "index": self.index,
+            "port": self.port,
+            "pid": self.process.pid if self.process else None,
+            "alive": self.alive,
+            "ready": self.ready,
+            "capacity": self.capacity,
+            "outstanding": self.outstanding,
+            "restarts": self.restarts,
+        }
+
+
+class Supervisor:
+    """Runs `count` copies of the server and spreads requests over them.
+
+    Each worker is a separate process listening on 127.0.0.1 with its own
+    BROWSER_DATA (so its own browser profile and sessions), its own Xvfb
+    display when NO_GUI is set, and its own share of OPENAI_ACCOUNTS when
+    there are enough accounts to go round. A worker that exits is started
+    again, waiting longer after each quick crash. With GATEWAY_URL set, the
+    supervisor registers with the gateway as one node, with the capacity of
+    all its workers; the workers themselves do not.
+    """
+
+    def __init__(self, count: int, port: int, args: list[str]):
+        self.count = count
+        self.args = args
+        self.workers = [
+            WorkerProcess(index, port + 1 + index) for index in range(count)
+        ]
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(5, read=None))
+        self.tasks: list[asyncio.Task] = []
+        self.stopping = False
+
+    def environ(self, worker: WorkerProcess) -> dict[str, str]:
+        env = dict(os.environ)
+        env["BROWSER_DATA"] = os.path.join(
+            os.getenv("BROWSER_DATA", os.getcwd()), f"worker-{worker.index}"
+        )
+        # 由调度进程代表所有worker向网关发送心跳
+        env.pop("GATEWAY_URL", None)
+        env["PYTHONPATH"] = os.pathsep.join(
+            path for path in (ROOT, env.get("PYTHONPATH")) if path
+        )
+        # 帐号足够时每个worker使用不同的帐号，否则共用
+        if len(config.OPENAI_ACCOUNTS) >= self.count:
+            env["OPENAI_ACCOUNTS"] = ",".join(
+                f"{email}:{password}"
+                for email, password in config.OPENAI_ACCOUNTS[
+                    worker.index :: self.count
+                ]
+            )
+        return env
+
+    async def start(self):
+        for worker in self.workers:
+            self.tasks.append(asyncio.create_task(self.keep_running(worker)))
+        self.tasks.append(asyncio.create_task(self.watch()))
+        if config.GATEWAY_URL:
+            from llm.gateway.node import report_to_gateway
+
+            self.tasks.append(
+                asyncio.create_task(report_to_gateway(self.heartbeat_body))
+            )
+
+    async def keep_running(self, worker: WorkerProcess):
+        while not self.stopping:
+            started = time.monotonic()
+            worker.process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-u",
+                MAIN,
+                "--port",
+                str(worker.port),
+                "--worker-index",
+                str(worker.index),
+                *self.args,
+                env=self.environ(worker),
+            )
+            logger.info(
+                f"[Supervisor.keep_running] Worker {worker.index} started on port {worker.port}, pid {worker.process.pid}"
+            )
+            code = await worker.process.wait()
+            worker.alive = worker.ready = False
+            if self.stopping:
+                return
+
+            if time.monotonic() - started > STABLE_AFTER:
+                worker.restarts = 0
+            delay = min(30, 2**worker.restarts)
+            worker.restarts += 1
+            logger.error(
+                f"[Supervisor.keep_running] Worker {worker.index} exited with code {code}, restarting in {delay}s"
+            )
+            await asyncio.sleep(delay)
+
+    async def watch(self):
+        while True:
+            await asyncio.gather(*(self.poll(worker) for worker in self.workers))
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def poll(self, worker: WorkerProcess):
+        if worker.process is None or worker.process.returncode is not None:
+            worker.alive = worker.ready = False
+            return
+        try:
+            response = await self.client.get(
+                f"{worker.url}/readyz", timeout=POLL_INTERVAL
+            )
+        except httpx.HTTPError:
+            worker.alive = worker.ready = False
+            return
+        worker.alive = True
+        worker.ready = response.status_code == 200
+        try:
+            status = response.json()
+            worker.capacity = status.get("capacity", 0)
+            worker.models = status.get("models", [])
+        except ValueError:
+            worker.capacity, worker.models = 0, []
+
+    def heartbeat_body(self) -> dict:
+        """Capacity and models of the ready workers, reported as one node"""
+        workers = [worker for worker in self.workers if worker.ready]
+        return {
+            "url": config.WORKER_URL,
+            "capacity": sum(worker.capacity for worker in workers),
+            "models": sorted({model for worker in workers for model in worker.models}),
+        }
+
+    def pick(self, exclude: set[int]) -> Optional[WorkerProcess]:
+        """The least loaded worker, ready ones first"""
+        workers = [worker for worker in self.workers if worker.index not in exclude]
+        candidates = [worker for worker in workers if worker.ready] or [
+            worker for worker in workers if worker.alive
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda worker: worker.outstanding)
+
+    async def stop(self):
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        # 等待心跳任务从网关注销
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        processes = [
+            worker.process
+            for worker in self.workers
+            if worker.process and worker.process.returncode is None
+        ]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                await asyncio.wait_for(process.wait(), timeout=STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+        await self.client.aclose()
+
+    async def dispatch(self, request: Request):
+        body = await request.body()
+        tried = set()
+        while True:
+            worker = self.pick(tried)
+            if worker is None:
+                raise HTTPException(
+                    status_code=503,
+                    detail="No worker is available",
+                    headers={"Retry-After": str(POLL_INTERVAL)},
+                )
+
+            worker.outstanding += 1
+
+            def on_close(worker=worker):
+                worker.outstanding -= 1
+
+            try:
+                return await forward(self.client, worker.url, request, body, on_close)
+            except httpx.ConnectError:
+                # 请求还没有发出，换一个worker
+                logger.error(
+                    f"[Supervisor.dispatch] Worker {worker.index} refused the connection"
+                )
+                worker.alive = worker.ready = False
+                tried.add(worker.index)
+            except httpx.HTTPError as e:
+                # 请求可能已经在处理，不能再发给别的worker
+                logger.error(
+                    f"[Supervisor.dispatch] Worker {worker.index} failed: {e!r}"
+                )
+                raise HTTPException(status_code=502, detail="Worker failed")
+
+
+def create_app(supervisor: Supervisor) -> FastAPI:
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await supervisor.start()
+        try:
+            yield
+        finally:
+            await supervisor.stop()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.get("/healthz")
+    async def healthz():
+        return {"status": "ok"}
+
+    @app.get("/readyz")
+    async def readyz():
+        ready = any(worker.ready for worker in supervisor.workers)
+        return JSONResponse(
+            status_code=200 if ready else 503,
+            content={
+                "ready": ready,
+                "workers": [worker.status() for worker in supervisor.workers],
+            },
+        )
+
+    @app.api_route(
+        "/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
+    )
+    async def dispatch(request: Request):
+        return await supervisor.dispatch(request)
+
+    return app
+
+
+def run_supervisor(count: int, port: int, timeout_keep_alive: int, args: list[str]):
+    supervisor = Supervisor(count, port, args)
+    logger.info(
+        f"[run_supervisor] Starting {count} workers on ports {port + 1}-{port + count}"
+    )
+    uvicorn.run(
+        create_app(supervisor),
+        host="0.0.0.0",
+        port=port,
+        timeout_keep_alive=timeout_keep_alive,
+    )
@@ -0,0 +1,38 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+
+class StageTimer:
+    """Time spent in each stage of a request, in the order the stages ended"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.stages: list[tuple[str, float]] = []
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.stages.append((name, now - self._last))
+        self._last = now
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f"{name};dur={duration * 1000:.1f}" for name, duration in self.stages
+        )
+
+    def summary(self) -> str:
+        total = time.perf_counter() - self.started
+        stages = " ".join(f"{name}={duration:.3f}s" for name, duration in self.stages)
+        return f"total={total:.3f}s {stages}"
+
+
+current_timer: ContextVar[Optional[StageTimer]] = ContextVar(
+    "stage_timer", default=None
+)
+
+
+def mark(name: str):
+    timer = current_timer.get()
+    if timer is not None:
+        timer.mark(name)
@@ -1,15 +1,138 @@
-from fastapi import HTTPException
+from typing import Callable, Optional
 
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+
+from llm import config, metrics, timing
 from llm.api.chat import ChatRequest
+from llm.cache import CacheControl, CacheEntry, response_cache
 from llm.provider_manager import provider_manager
+from llm.scheduler import QueueFullError, scheduler
+from llm.single_flight import single_flight
+
+
+def response_headers(resp, response: Response):
+    """Headers of a StreamingResponse go on itself, dicts use the injected one"""
+    return resp.headers if isinstance(resp, StreamingResponse) else response.headers
 
 
-async def api_chat_completion(body: ChatRequest):
-    provider = provider_manager.get_provider(body.model)
-    if not provider:
+async def api_chat_completion(body: ChatRequest, request: Request, response: Response):
+    if not provider_manager.get_provider(body.model):
+        metrics.REQUESTS.inc(model="unsupported", status=400)
         raise HTTPException(status_code=400, detail=f"Unsupported model {body.model}")
 
-    resp = await provider.chat_completion(
-        model=body.model, messages=body.messages, stream=body.stream
-    )
-    return resp
+    cache_control = CacheControl(request.headers.get("cache-control"))
+    key = response_cache.key(body.model, body.messages)
+    cache_status = "BYPASS"
+    if response_cache.enabled and cache_control.lookup:
+        entry = await response_cache.get(key, cache_control.max_age)
+        timing.mark("cache")
+        if entry is not None:
+            metrics.REQUESTS.inc(model=body.model, status=200)
+            resp = response_cache.respond(entry, body.stream)
+            headers = response_headers(resp, response)
+            headers["X-Cache"] = "HIT"
+            headers["Age"] = str(int(entry.age))
+            return resp
+        cache_status = "MISS"
+
+    flight = None
+    if config.COALESCE_REQUESTS and cache_control.lookup:
+        leader = single_flight.join(key)
+        if leader is not None:
+            resp = await single_flight.respond(leader, body.stream)
+            timing.mark("coalesce")
+            if resp is not None:
+                metrics.REQUESTS.inc(model=body.model, status=200)
+                response_headers(resp, response)["X-Coalesced"] = "true"
+                return resp
+        # 领头的请求失败时自己发送请求，这时可能已经有别的请求领头
+        if key not in single_flight.flights:
+            flight = single_flight.lead(key, body.model)
+
+    store = response_cache.enabled and cache_control.store
+
+    def on_finish(completion):
+        if store:
+            response_cache.put(
+                key,
+                CacheEntry(
+                    completion.content, completion.model, completion.finish_reason
+                ),
+            )
+        if flight is not None:
+            flight.finish(completion.model, completion.finish_reason)
+
+    # 流式输出时，在输出结束后才结束共享
+    land_flight = flight is not None
+    try:
+        resp = await complete(
+            body, response, on_finish, flight.add_delta if flight else None
+        )
+        if flight is not None and isinstance(resp, StreamingResponse):
+            resp.body_iterator = single_flight.land_after(
+                resp.body_iterator, key, flight
+            )
+            land_flight = False
+        if response_cache.enabled:
+            response_headers(resp, response)["X-Cache"] = cache_status
+        return resp
+    finally:
+        if land_flight:
+            single_flight.land(key, flight)
+
+
+async def complete(
+    body: ChatRequest,
+    response: Response,
+    on_finish: Callable,
+    on_delta: Optional[Callable],
+):
+    """Queue for admission and run the completion on the least loaded provider"""
+    # 所有帐号都启动失败时直接返回，不再排队
+    unavailable = provider_manager.unavailable(body.model)
+    if unavailable:
+        metrics.REQUESTS.inc(model=body.model, status=503)
+        raise HTTPException(status_code=503, detail=unavailable)
+
+    try:
+        admission = await scheduler.acquire()
+    except QueueFullError as e:
+        metrics.REQUESTS.inc(model=body.model, status=429)
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    timing.mark("queue")
+
+    # 流式输出时，在输出结束后才释放排队位置
+    release_admission = True
+    try:
+        # 排队结束后再选择负载最低的帐号
+        provider = provider_manager.get_provider(body.model)
+        try:
+            resp = await provider.chat_completion(
+                model=body.model,
+                messages=body.messages,
+                stream=body.stream,
+                on_finish=on_finish,
+                on_delta=on_delta,
+            )
+        except Exception:
+            metrics.REQUESTS.inc(model=body.model, status=500)
+            raise
+        # 帐号出错时返回的错误内容状态码也是200，单独计数
+        failed = isinstance(resp, dict) and resp.get("status") is False
+        metrics.REQUESTS.inc(model=body.model, status="error" if failed else 200)
+
+        if isinstance(resp, StreamingResponse):
+            resp.body_iterator = scheduler.release_after(resp.body_iterator, admission)
+            release_admission = False
+        response_headers(resp, response)["X-Queue-Time"] = str(
+            round(admission.wait_time, 4)
+        )
+        return resp
+    finally:
+        if release_admission:
+            scheduler.release(admission)
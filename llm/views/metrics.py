@@ -0,0 +1,28 @@
+from fastapi.responses import PlainTextResponse
+
+from llm import metrics
+from llm.provider_manager import provider_manager
+from llm.scheduler import scheduler
+
+
+def page_samples():
+    for provider, crawlers in provider_manager.get_all_providers().items():
+        for index, crawler in enumerate(crawlers):
+            for state, count in crawler.page_stats().items():
+                yield {"account": f"{provider}-{index}", "state": state}, count
+
+
+def queue_samples():
+    yield {"state": "capacity"}, scheduler.capacity
+    yield {"state": "active"}, scheduler.active
+    yield {"state": "waiting"}, scheduler.queue_depth
+
+
+metrics.PAGES.set_function(page_samples)
+metrics.QUEUE.set_function(queue_samples)
+
+
+async def api_metrics():
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
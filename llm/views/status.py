@@ -0,0 +1,26 @@
+from fastapi.responses import JSONResponse
+
+from llm.provider_manager import provider_manager
+from llm.scheduler import scheduler
+
+
+async def api_queue_status():
+    return scheduler.stats()
+
+
+async def api_healthz():
+    return {"status": "ok"}
+
+
+async def api_readyz():
+    """Ready once at least one page can take requests"""
+    ready = provider_manager.capacity > 0
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "capacity": provider_manager.capacity,
+            "models": provider_manager.models,
+            "providers": provider_manager.startup_status(),
+        },
+    )
@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+from llm.provider.openai.resource_blocker import ResourceBlocker, allowed_hosts
+
+LOGIN_URL = "https://auth.openai.com/authorize?client_id=x&response_type=code"
+
+
+def request(url: str, resource_type: str = "document"):
+    return SimpleNamespace(url=url, resource_type=resource_type)
+
+
+def test_email_login_page_is_allowed():
+    blocker = ResourceBlocker(["document", "script"], allowed_hosts("email"))
+    assert blocker.allowed(request(LOGIN_URL))
+    assert blocker.allowed(request("https://cdn.auth0.com/ulp/app.js", "script"))
+
+
+def test_login_page_is_blocked_without_email_login():
+    blocker = ResourceBlocker(["document"], allowed_hosts("nologin"))
+    assert not blocker.allowed(request(LOGIN_URL))
+
+
+def test_resource_type_is_still_checked():
+    blocker = ResourceBlocker(["document"], allowed_hosts("email"))
+    assert not blocker.allowed(request("https://auth.openai.com/logo.png", "image"))